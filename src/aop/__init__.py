@@ -1,4 +1,5 @@
 from .cache_decorate import *
 from .error_log_middleware import *
+from .server_timing_middleware import *
 from ..oop.log_route import *
 from .orm_listen import *
@@ -1,13 +1,37 @@
 # -*- encoding: utf-8 -*-
 
+import sys
+import json
+import time
+import uuid
+import pickle
 import asyncio
 import functools
+import traceback
 import collections
-from typing import List, Dict, Any
+from typing import List, Dict, Set, Any, Iterable, Callable, Awaitable
 
 from pydantic import BaseModel
 
-from src.core import f_log
+from src.core import (
+    f_log,
+    current_request,
+    CACHE_MAX_ENTRIES,
+    CACHE_MAX_BYTES,
+    CACHE_DEFAULT_TTL,
+    CACHE_L2_ENABLED,
+    CACHE_REDIS_PREFIX,
+    CACHE_REDIS_MAX_TTL,
+    CACHE_INVALIDATE_TOPIC,
+    SINGLE_FLIGHT_DISTRIBUTED,
+    IDEMPOTENCY_HEADER,
+    CACHE_WARMUP_CONCURRENCY,
+    CACHE_WARMUP_TIMEOUT,
+)
+from src.db import redis_db, get_auto_pipeline
+from src.utils.redis_pubsub import RedisPubSubHandle
+from src.utils.redis_single_flight import single_flight
+from src.utils.redis_idempotency import idempotency_store
 
 
 class LocalEvent(asyncio.Event):
@@ -19,6 +43,7 @@ class LocalEvent(asyncio.Event):
     def __init__(self) -> None:
         super().__init__()
         self._save_val = None
+        self._save_exc = None
 
     def set_val(self, val) -> None:
         """Set the internal flag to true. All coroutines waiting for it to
@@ -33,7 +58,20 @@ class LocalEvent(asyncio.Event):
                 if not fut.done():
                     fut.set_result(val)
 
+    def set_exc(self, exc: BaseException) -> None:
+        """请求函数出错时, 将异常传递给所有等待者, 避免等待者永远阻塞"""
+        if not self._value:
+            self._value = True
+            self._save_exc = exc
+
+            for fut in self._waiters:
+                if not fut.done():
+                    fut.set_exception(exc)
+
     async def wait_val(self):
+        if self._save_exc is not None:
+            raise self._save_exc
+
         # 为了防止丢失 set_val 方法
         if self._save_val:
             return self._save_val
@@ -50,18 +88,208 @@ class LocalEvent(asyncio.Event):
             self._waiters.remove(fut)
 
 
+class CacheEntry(object):
+    """
+    缓存条目, 使用 __slots__ 减少每个条目的内存占用
+    """
+    __slots__ = ("key", "value", "size", "expire_at", "stale_until", "tags", "etag")
+
+    def __init__(
+            self,
+            key: str,
+            value: Any,
+            size: int,
+            expire_at: float | None,
+            tags: tuple = (),
+            stale_until: float | None = None,
+    ) -> None:
+        self.key = key
+        self.value = value
+        self.size = size
+        # time.monotonic() 时间戳, None 表示永不过期
+        self.expire_at = expire_at
+        # 过期后仍然可以作为旧值返回的截止时间
+        self.stale_until = stale_until if stale_until is not None else expire_at
+        self.tags = tags
+        # 值的版本标识, 用于 http 条件请求, 第一次需要时再计算
+        self.etag = None
+
+    def is_expired(self, now: float) -> bool:
+        return self.expire_at is not None and self.expire_at <= now
+
+    def is_dead(self, now: float) -> bool:
+        return self.stale_until is not None and self.stale_until <= now
+
+
+def get_size(value: Any) -> int:
+    """估算缓存值占用的字节数"""
+    if isinstance(value, BaseModel):
+        return len(value.model_dump_json())
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    try:
+        return len(json.dumps(value, default=str))
+    except Exception:
+        return sys.getsizeof(value)
+
+
 class Cache(object):
-    def __init__(self):
-        self.cache_map = {}
+    """
+    进程内 LRU + TTL 缓存
+        1. 每个条目可以单独设置过期时间, 过期的条目在访问时惰性删除
+        2. 条目数量超过 max_entries 或估算字节数超过 max_bytes 时, 淘汰最久未使用的条目
+        3. 条目可以携带标签, 按标签失效只会删除受影响的条目
+    """
 
-    def get(self, key) -> Any:
-        return self.cache_map.get(key)
+    def __init__(
+            self,
+            max_entries: int = CACHE_MAX_ENTRIES,
+            max_bytes: int = CACHE_MAX_BYTES,
+            default_ttl: float = CACHE_DEFAULT_TTL,
+    ):
+        self.cache_map: collections.OrderedDict[str, CacheEntry] = collections.OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.current_bytes = 0
+        # tag -> 该标签下的所有 key
+        self.tag_map: Dict[str, Set[str]] = {}
+        # tag -> 失效次数, 用于判断计算期间标签是否被失效过
+        self.tag_versions: Dict[str, int] = {}
+        # clear 的次数, 作为版本的一部分, 清空期间计算中的结果不论标签是否失效过都不再写入
+        self.generation = 0
+        # 标签前缀 -> 按前缀失效的次数, 同样作为版本的一部分
+        self.prefix_versions: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.cache_map)
 
-    def set(self, key, value) -> None:
-        self.cache_map[key] = value
+    def get(self, key) -> Any:
+        entry = self.cache_map.get(key)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if entry.is_expired(now):
+            if entry.is_dead(now):
+                self.remove(key)
+            return None
+        self.cache_map.move_to_end(key)
+        return entry.value
+
+    def get_stale(self, key) -> Any:
+        """返回已过期, 但还在 stale_ttl 内的旧值"""
+        entry = self.cache_map.get(key)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if entry.is_dead(now):
+            self.remove(key)
+            return None
+        self.cache_map.move_to_end(key)
+        return entry.value
+
+    def set(
+            self,
+            key,
+            value,
+            ttl: float | None = None,
+            max_size: int | None = None,
+            tags: Iterable[str] = (),
+            tag_version: tuple | None = None,
+            stale_ttl: float | None = None,
+    ) -> bool:
+        """
+        :param ttl: 过期秒数, None 使用 default_ttl, 0 表示永不过期
+        :param max_size: 单个条目允许的最大字节数, 超过则不缓存
+        :param tags: 条目所属的标签
+        :param stale_ttl: 过期后还可以通过 get_stale 获取旧值的秒数
+        :param tag_version: 计算前通过 get_tag_version 获取的版本, 计算期间标签被失效过则不写入
+        :return: 是否写入了缓存
+        """
+        tags = tuple(tags)
+        if tag_version is not None and tag_version != self.get_tag_version(tags):
+            return False
+
+        size = get_size(value)
+        if size > self.max_bytes or (max_size and size > max_size):
+            self.remove(key)
+            return False
+
+        ttl = self.default_ttl if ttl is None else ttl
+        expire_at = time.monotonic() + ttl if ttl else None
+        stale_until = expire_at + stale_ttl if expire_at is not None and stale_ttl else None
+
+        self.remove(key)
+        self.cache_map[key] = CacheEntry(key, value, size, expire_at, tags, stale_until)
+        self.current_bytes += size
+        for tag in tags:
+            self.tag_map.setdefault(tag, set()).add(key)
+        self._evict()
+        return True
+
+    def remove(self, key) -> None:
+        entry = self.cache_map.pop(key, None)
+        if entry is not None:
+            self._forget(entry)
+
+    def _forget(self, entry: CacheEntry) -> None:
+        self.current_bytes -= entry.size
+        for tag in entry.tags:
+            keys = self.tag_map.get(tag)
+            if keys is None:
+                continue
+            keys.discard(entry.key)
+            if not keys:
+                del self.tag_map[tag]
+
+    def _evict(self) -> None:
+        while self.cache_map and (
+                len(self.cache_map) > self.max_entries or self.current_bytes > self.max_bytes
+        ):
+            _, entry = self.cache_map.popitem(last=False)
+            self._forget(entry)
+
+    def get_tag_version(self, tags: Iterable[str]) -> tuple:
+        return (
+            self.generation,
+            tuple(sorted(self.prefix_versions.items())),
+            *(self.tag_versions.get(tag, 0) for tag in tags),
+        )
+
+    def invalidate_tags(self, tags: Iterable[str]) -> int:
+        """删除标签下的所有条目, 代价只和受影响的条目数量有关, 返回删除的条目数量"""
+        count = 0
+        for tag in tags:
+            self.tag_versions[tag] = self.tag_versions.get(tag, 0) + 1
+            for key in self.tag_map.pop(tag, ()):
+                if key in self.cache_map:
+                    self.remove(key)
+                    count += 1
+        return count
+
+    def invalidate_prefix(self, prefix: str) -> int:
+        """删除所有以 prefix 开头的标签下的条目, 计算中的结果即使标签还没有出现过也不再写入"""
+        self.prefix_versions[prefix] = self.prefix_versions.get(prefix, 0) + 1
+        return self.invalidate_tags([tag for tag in self.tag_map if tag.startswith(prefix)])
 
     def clear(self) -> None:
         self.cache_map.clear()
+        self.tag_map.clear()
+        self.current_bytes = 0
+        # 让正在计算中的结果也不再写入, 包括从未失效过的标签
+        self.generation += 1
+
+    def get_etag(self, key, value) -> str | None:
+        """条目的版本标识, 只有缓存中的值就是 value 时才有效"""
+        entry = self.cache_map.get(key)
+        if entry is None or entry.value is not value:
+            return None
+        return entry.etag
+
+    def set_etag(self, key, value, etag: str) -> None:
+        entry = self.cache_map.get(key)
+        if entry is not None and entry.value is value:
+            entry.etag = etag
 
     def get_key(self, request_body: BaseModel | str, func, cls_name: str) -> str:
         if isinstance(request_body, BaseModel):
@@ -70,34 +298,414 @@ class Cache(object):
             cache_key = str(request_body)
         return cls_name + ":" + func.__name__ + ":" + cache_key
 
+    def get_tags(self, func, cls_name: str, tags: Iterable[str] = ()) -> tuple:
+        """
+        查询结果默认带有 cls_name 和 cls_name:func.__name__ 两个标签,
+        后者即 get_key 生成的 key 的前缀, 可以按视图或者按视图的某个方法失效
+        """
+        return (cls_name, cls_name + ":" + func.__name__, *tags)
+
+
+class RedisCache(object):
+    """
+    多个 worker 共享的二级缓存, 值使用 pickle 序列化
+    标签保存在 redis zset 中, score 为 key 的过期时间戳 (ms), 写入时删除已过期的成员, 失效时删除标签下的所有 key
+    每个标签在 redis 中还有一个版本号, 失效时加 1, 计算前读取版本, 写入时版本变化过则不写入,
+    避免其他 worker 的写操作失效缓存后, 本 worker 在收到失效通知前把计算出的旧值写回二级缓存
+    """
+
+    # KEYS 按标签每 3 个一组: zset 标签, 旧版本的 set 标签, 标签版本; ARGV[1] 值 key 的前缀, ARGV[2] 版本的过期秒数
+    # 先增加版本, 再删除标签集合中的所有 key 以及标签集合本身, 保证失效期间新写入的 key 不会丢失标签
+    invalidate_script = """
+    local count = 0
+    for i = 1, #KEYS, 3 do
+        redis.call("incr", KEYS[i + 2])
+        redis.call("expire", KEYS[i + 2], ARGV[2])
+        for _, tag_key in ipairs({KEYS[i], KEYS[i + 1]}) do
+            local tag_type = redis.call("type", tag_key).ok
+            local keys = {}
+            if tag_type == "zset" then
+                keys = redis.call("zrange", tag_key, 0, -1)
+            elseif tag_type == "set" then
+                keys = redis.call("smembers", tag_key)
+            end
+            for _, key in ipairs(keys) do
+                count = count + redis.call("del", ARGV[1] .. key)
+            end
+            redis.call("del", tag_key)
+        end
+    end
+    return count
+    """
+
+    # KEYS[1] 值的 key, 之后 n + 1 个版本 key (第一个为全局版本), 最后 n 个 zset 标签
+    # ARGV: 值, px, 成员的过期时间戳, 当前时间戳, 成员名, 标签集合的过期秒数, n, 之后为计算前读取的 n + 1 个版本
+    # 任意一个版本变化过则不写入, 返回 0
+    set_script = """
+    local n = tonumber(ARGV[7])
+    for i = 1, n + 1 do
+        if (redis.call("get", KEYS[1 + i]) or "0") ~= ARGV[7 + i] then
+            return 0
+        end
+    end
+    redis.call("set", KEYS[1], ARGV[1], "px", ARGV[2])
+    for i = 1, n do
+        local tag_key = KEYS[2 + n + i]
+        redis.call("zadd", tag_key, ARGV[3], ARGV[5])
+        redis.call("zremrangebyscore", tag_key, "-inf", ARGV[4])
+        redis.call("expire", tag_key, ARGV[6])
+    end
+    return 1
+    """
+
+    def __init__(self, client=None, prefix: str = CACHE_REDIS_PREFIX, max_ttl: int = CACHE_REDIS_MAX_TTL):
+        self.client = client or redis_db
+        self.prefix = prefix
+        self.max_ttl = max_ttl
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}:key:{key}"
+
+    def _tag_key(self, tag: str) -> str:
+        return f"{self.prefix}:ztag:{tag}"
+
+    def _legacy_tag_key(self, tag: str) -> str:
+        # 旧版本的 set 类型标签, 最多 max_ttl 后自动过期
+        return f"{self.prefix}:tag:{tag}"
+
+    def _version_key(self, tag: str) -> str:
+        return f"{self.prefix}:tagver:{tag}"
+
+    def _generation_key(self) -> str:
+        # clear 时加 1, 作为所有条目共同的版本
+        return f"{self.prefix}:generation"
+
+    async def get_tag_versions(self, tags: Iterable[str]) -> List[str]:
+        """计算前读取全局版本和标签版本, 写入时传给 set"""
+        keys = [self._generation_key(), *(self._version_key(tag) for tag in tags)]
+        versions = await get_auto_pipeline(self.client).execute_command("MGET", *keys)
+        return [version.decode() if version is not None else "0" for version in versions]
+
+    async def get(self, key: str) -> tuple[Any, float | None]:
+        """:return: (值, 剩余过期秒数), 未命中时值为 None"""
+        # 通过自动 pipeline 发送, 同一时刻其他请求的缓存读取也合并到同一次往返中
+        # 始终读取主库: 失效后从库可能还保留旧值, 读到后会重新写入本地缓存
+        pipe = get_auto_pipeline(self.client)
+        raw, pttl = await asyncio.gather(pipe.get(self._key(key)), pipe.pttl(self._key(key)))
+        if raw is None:
+            return None, None
+        return pickle.loads(raw), (pttl / 1000 if pttl and pttl > 0 else None)
+
+    async def set(
+            self,
+            key: str,
+            value: Any,
+            ttl: float | None = None,
+            tags: Iterable[str] = (),
+            tag_versions: List[str] | None = None,
+    ) -> bool:
+        """
+        :param tag_versions: 计算前通过 get_tag_versions 读取的版本, None 表示不检查
+        :return: 是否写入了缓存
+        """
+        tags = tuple(tags)
+        ttl = CACHE_DEFAULT_TTL if ttl is None else ttl
+        # 二级缓存不允许永不过期, 保证标签集合比它包含的 key 存活得更久
+        ttl = min(ttl, self.max_ttl) if ttl else self.max_ttl
+        now = int(time.time() * 1000)
+        if tag_versions is None:
+            # 不检查版本时, 使用当前版本
+            tag_versions = await self.get_tag_versions(tags)
+        keys = [
+            self._key(key),
+            self._generation_key(),
+            *(self._version_key(tag) for tag in tags),
+            *(self._tag_key(tag) for tag in tags),
+        ]
+        args = [
+            pickle.dumps(value), int(ttl * 1000), now + int(ttl * 1000), now, key, self.max_ttl, len(tags),
+            *tag_versions,
+        ]
+        # 写入值和标签时顺便删除标签中已过期的 key, 热点标签的成员数量不会无限增长
+        return bool(await self.client.eval(self.set_script, len(keys), *keys, *args))
+
+    async def invalidate_tags(self, tags: Iterable[str]) -> int:
+        tag_keys = [
+            tag_key
+            for tag in tags
+            for tag_key in (self._tag_key(tag), self._legacy_tag_key(tag), self._version_key(tag))
+        ]
+        if not tag_keys:
+            return 0
+        return await self.client.eval(self.invalidate_script, len(tag_keys), *tag_keys, self._key(""), self.max_ttl)
+
+    async def clear(self) -> None:
+        # 先增加全局版本, 计算中的结果不再写入; 全局版本本身不删除
+        generation_key = self._generation_key()
+        await self.client.incr(generation_key)
+        # 每 1000 个 key 删除一次, 而不是每个 key 一次往返
+        keys = []
+        async for key in self.client.scan_iter(match=f"{self.prefix}:*", count=1000):
+            if key.decode() == generation_key:
+                continue
+            keys.append(key)
+            if len(keys) >= 1000:
+                await self.client.unlink(*keys)
+                keys = []
+        if keys:
+            await self.client.unlink(*keys)
+
 
 cache = Cache()
+redis_cache = RedisCache()
 e_list: Dict[str, List[LocalEvent]] = collections.defaultdict(list)
 
+# 当前 worker 的标识, 收到自己发布的失效事件时跳过
+WORKER_ID = uuid.uuid4().hex
+
+
+async def invalidate_cache(
+        tags: Iterable[str] = (),
+        clear_all: bool = False,
+        l2: bool = CACHE_L2_ENABLED,
+        tag_prefix: str | None = None,
+) -> int:
+    """
+    失效本地缓存, l2 为 True 时同时失效 redis 二级缓存, 并通知其他 worker 失效各自的本地缓存
+    :param tag_prefix: 同时失效所有以该前缀开头的标签, 只作用于各个 worker 的本地缓存, 不扫描 redis
+    :return: 本地删除的条目数量
+    """
+    tags = tuple(tags)
+    count = len(cache) if clear_all else cache.invalidate_tags(tags)
+    if clear_all:
+        cache.clear()
+    elif tag_prefix:
+        count += cache.invalidate_prefix(tag_prefix)
+    if not l2:
+        return count
+
+    try:
+        if clear_all:
+            await redis_cache.clear()
+        elif tags:
+            await redis_cache.invalidate_tags(tags)
+    except Exception:
+        f_log.error(f"invalidate redis cache error: {traceback.format_exc()}")
+    await publish_invalidation(tags, clear_all, tag_prefix)
+    return count
+
+
+async def publish_invalidation(
+        tags: Iterable[str] = (),
+        clear_all: bool = False,
+        tag_prefix: str | None = None,
+) -> None:
+    """只通知其他 worker 失效各自的本地缓存, 不修改 redis 二级缓存"""
+    try:
+        await RedisPubSubHandle(redis_db).publish(
+            CACHE_INVALIDATE_TOPIC,
+            {"origin": WORKER_ID, "tags": list(tags), "clear_all": clear_all, "tag_prefix": tag_prefix},
+            maxlen=1000,
+        )
+    except Exception:
+        f_log.error(f"publish cache invalidation error: {traceback.format_exc()}")
+
+
+async def on_cache_invalidate(message: dict) -> None:
+    if message.get("origin") == WORKER_ID:
+        return
+    if message.get("clear_all"):
+        cache.clear()
+        return
+    cache.invalidate_tags(message.get("tags") or ())
+    if message.get("tag_prefix"):
+        cache.invalidate_prefix(message["tag_prefix"])
+
+
+_listener_started = False
+
+
+async def start_cache_invalidation_listener() -> None:
+    """
+    订阅其他 worker 发布的失效事件, 需要在事件循环中调用
+    CACHE_L2_ENABLED 时在 lifespan 中启动, 否则在第一次使用二级缓存时启动
+    """
+    global _listener_started
+    if _listener_started:
+        return
+    _listener_started = True
+    await RedisPubSubHandle(redis_db).subscribe(on_cache_invalidate, CACHE_INVALIDATE_TOPIC)
+
+
+def wake_events(cache_key: str, result: Any = None, exc: BaseException | None = None) -> None:
+    """唤醒 cache_key 上的所有等待者, 并回收 e_list 中的空列表"""
+    for event in e_list.pop(cache_key, []):
+        if exc is not None:
+            event.set_exc(exc)
+        else:
+            event.set_val(result)
+
 
 # 清除缓存的装饰器, 用于更新箱子的函数
-def clear_cache_decorator(func):
+def clear_cache_decorator(
+        func=None,
+        *,
+        tags: Iterable[str] | None = None,
+        clear_all: bool = False,
+        l2: bool | None = None,
+):
+    """
+    默认只失效当前视图 (cls_name 标签) 的缓存, 也可以声明需要失效的标签, 例如:
+        "method_decorator": {"post": clear_cache_decorator(tags=["ApiView:get", "box"])}
+    :param tags: 需要失效的标签, 可以是 get_cache_decorator 中声明的标签, 或者 cls_name:func.__name__ 前缀
+    :param clear_all: 清空整个缓存
+    :param l2: 是否同时失效 redis 二级缓存并通知其他 worker, 默认为 CACHE_L2_ENABLED
+    """
+    if func is None:
+        return functools.partial(clear_cache_decorator, tags=tags, clear_all=clear_all, l2=l2)
+
+    use_l2 = CACHE_L2_ENABLED if l2 is None else l2
+
     @functools.wraps(func)
     async def wrap(cls_name, *args, **kwargs):
 
-        f_log.info(f"clear_cache_decorator clear cache...")
         result = await func(*args, **kwargs)
-        cache.clear()
+        if clear_all:
+            f_log.info(f"clear_cache_decorator clear cache...")
+            await invalidate_cache(clear_all=True, l2=use_l2)
+        else:
+            invalidate_tags = tuple(tags) if tags is not None else (cls_name,)
+            count = await invalidate_cache(invalidate_tags, l2=use_l2)
+            f_log.info(f"clear_cache_decorator invalidate tags {invalidate_tags}, {count} entries")
 
         return result
 
     return wrap
 
 
+# 缓存预热任务, (名称, 无参数的异步函数), 由 BaseApiView.as_view 根据路由的 warmup 参数注册
+warmup_registry: List[tuple[str, Callable[[], Awaitable]]] = []
+
+
+def register_warmup(name: str, func: Callable[[], Awaitable]) -> None:
+    warmup_registry.append((name, func))
+
+
+async def run_cache_warmup(
+        concurrency: int = CACHE_WARMUP_CONCURRENCY,
+        timeout: float = CACHE_WARMUP_TIMEOUT,
+) -> tuple[int, float]:
+    """
+    并发执行所有预热任务, 在 lifespan 中调用, 预热完成后 worker 才开始处理请求
+    :return: (成功加载的数量, 耗时秒数)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(name: str, func: Callable[[], Awaitable]) -> bool:
+        async with semaphore:
+            try:
+                await func()
+                return True
+            except Exception:
+                f_log.error(f"cache warmup {name} error: {traceback.format_exc()}")
+                return False
+
+    start_time = time.monotonic()
+    tasks = [asyncio.create_task(run_one(name, func)) for name, func in warmup_registry]
+    done, pending = await asyncio.wait(tasks, timeout=timeout) if tasks else (set(), set())
+    for task in pending:
+        task.cancel()
+    if pending:
+        f_log.warning(f"cache warmup timeout, {len(pending)} jobs cancelled")
+
+    loaded = sum(1 for task in done if task.result())
+    return loaded, time.monotonic() - start_time
+
+
+async def get_l2(cache_key: str) -> tuple[Any, float | None]:
+    # 二级缓存不可用时降级为只使用本地缓存
+    try:
+        await start_cache_invalidation_listener()
+        return await redis_cache.get(cache_key)
+    except Exception:
+        f_log.error(f"get redis cache error: {traceback.format_exc()}")
+        return None, None
+
+
+async def get_l2_versions(tags: Iterable[str]) -> List[str] | None:
+    try:
+        return await redis_cache.get_tag_versions(tags)
+    except Exception:
+        f_log.error(f"get redis cache versions error: {traceback.format_exc()}")
+        return None
+
+
+async def set_l2(
+        cache_key: str,
+        value: Any,
+        ttl: float | None,
+        tags: Iterable[str],
+        tag_versions: List[str],
+) -> None:
+    try:
+        if not await redis_cache.set(cache_key, value, ttl=ttl, tags=tags, tag_versions=tag_versions):
+            # 计算期间其他 worker 失效了这些标签, 本地缓存中的也是旧值
+            cache.remove(cache_key)
+    except Exception:
+        f_log.error(f"set redis cache error: {traceback.format_exc()}")
+
+
+async def run_func(cache_key: str, func, args, kwargs, distributed: bool) -> Any:
+    """
+    e_list 只能合并当前 worker 中的相同请求,
+    distributed 为 True 时, 由 redis 选出的 leader 执行, 其他 worker 等待 leader 的结果
+    """
+    if not distributed:
+        return await func(*args, **kwargs)
+    return await single_flight.do(cache_key, lambda: func(*args, **kwargs))
+
+
 # 请求箱子信息的装饰器, 仅用于查询接口
-def get_cache_decorator(func):
+def get_cache_decorator(
+        func=None,
+        *,
+        ttl: float | None = None,
+        max_size: int | None = None,
+        tags: Iterable[str] = (),
+        l2: bool | None = None,
+        stale_ttl: float | None = None,
+        distributed: bool | None = None,
+):
+    """
+    可以直接使用, 也可以带参数使用, 例如:
+        "method_decorator": {"get": get_cache_decorator(ttl=30, max_size=64 * 1024, tags=["box"])}
+    :param ttl: 缓存过期秒数, 默认为 CACHE_DEFAULT_TTL
+    :param max_size: 单个结果允许缓存的最大字节数
+    :param tags: 额外的缓存标签, 供 clear_cache_decorator 按标签失效
+    :param l2: 本地缓存未命中时是否查询 redis 二级缓存, 默认为 CACHE_L2_ENABLED
+    :param stale_ttl: 开启 stale-while-revalidate, 过期后 stale_ttl 秒内直接返回旧值并在后台刷新,
+        超过 stale_ttl 后请求才会等待新的结果; 被失效的缓存不会作为旧值返回
+    :param distributed: 是否跨 worker 合并相同的请求, 默认为 SINGLE_FLIGHT_DISTRIBUTED
+    """
+    if func is None:
+        return functools.partial(
+            get_cache_decorator, ttl=ttl, max_size=max_size, tags=tags, l2=l2,
+            stale_ttl=stale_ttl, distributed=distributed
+        )
+
+    use_l2 = CACHE_L2_ENABLED if l2 is None else l2
+    use_distributed = SINGLE_FLIGHT_DISTRIBUTED if distributed is None else distributed
+
     @functools.wraps(func)
     async def wrap(cls_name, *args, **kwargs):
         cache_key = cache.get_key(kwargs.get("request_body"), func, cls_name)
+        cache_tags = cache.get_tags(func, cls_name, tags)
         result = cache.get(cache_key)
         if result:
             return result
 
+        stale = cache.get_stale(cache_key) if stale_ttl else None
+
         # 可以模拟并发请求
         # await asyncio.sleep(5)
 
@@ -114,17 +722,48 @@ def get_cache_decorator(func):
         if e_list_length == 0 and len(e_list[cache_key]) == 1:
             # 为了避免缓存击穿, 只对第一个请求调用请求函数, 其他的请求则通过 event.wait_val 获取结果
             async def get_result():
-                # 当上一批的 event 全部已经 set_val, 就可以不用调用请求函数
-                result = cache.get(cache_key)
-                if not result:
-                    result = await func(*args, **kwargs)
-                    cache.set(cache_key, result)
+                save_l2 = False
+                try:
+                    # 当上一批的 event 全部已经 set_val, 就可以不用调用请求函数
+                    result = cache.get(cache_key)
+                    if not result:
+                        tag_version = cache.get_tag_version(cache_tags)
+                        l2_ttl, l2_versions = None, None
+                        if use_l2:
+                            # 版本和值在同一次往返中读取, 版本用于写入二级缓存前检查其他 worker 是否失效过
+                            (result, l2_ttl), l2_versions = await asyncio.gather(
+                                get_l2(cache_key), get_l2_versions(cache_tags)
+                            )
+                        if result:
+                            # 本地缓存的过期时间不超过二级缓存的剩余时间
+                            local_ttl = cache.default_ttl if ttl is None else ttl
+                            if l2_ttl is not None:
+                                local_ttl = min(local_ttl, l2_ttl) if local_ttl else l2_ttl
+                        else:
+                            result = await run_func(cache_key, func, args, kwargs, use_distributed)
+                            # 读取版本失败时不写入二级缓存
+                            local_ttl, save_l2 = ttl, use_l2 and l2_versions is not None
+                        # 计算期间有写操作失效了这些标签, 则不写入缓存, 避免缓存旧数据
+                        save_l2 = cache.set(
+                            cache_key, result, ttl=local_ttl, max_size=max_size,
+                            tags=cache_tags, tag_version=tag_version, stale_ttl=stale_ttl
+                        ) and save_l2
+                except Exception as e:
+                    wake_events(cache_key, exc=e)
+                    return
                 # 这里缓存被清理也没事
-                while e_list[cache_key]:
-                    e_list[cache_key].pop().set_val(result)
+                wake_events(cache_key, result)
+
+                # 先唤醒等待者, 再写入二级缓存
+                if save_l2:
+                    await set_l2(cache_key, result, ttl, cache_tags, l2_versions)
 
             _task = asyncio.create_task(get_result())
 
+        # 有旧值时不等待, 由第一个请求创建的任务在后台刷新缓存, 之后的请求同样直接返回旧值
+        if stale:
+            return stale
+
         # 这里不要加await的操作, 否则可能丢失 set_val 方法
         # # await asyncio.sleep(5)
         return await event.wait_val()
@@ -134,10 +773,52 @@ def get_cache_decorator(func):
 # 防止重复执行的装饰器, 用于回调接口, 相同事件的请求, 只执行一次
 
 
-def only_one_exec_decorate(func):
+def get_idempotency_key(request_body, func, cls_name: str, header: str) -> str:
+    """优先使用请求头中的幂等键, 没有时使用请求体生成的 key"""
+    request = current_request.get()
+    header_key = request.headers.get(header) if request is not None else None
+    if header_key:
+        return cls_name + ":" + func.__name__ + ":" + header_key
+    return cache.get_key(request_body, func, cls_name)
+
+
+def only_one_exec_decorate(
+        func=None,
+        *,
+        distributed: bool | None = None,
+        idempotent: bool = False,
+        idempotency_ttl: int | None = None,
+        idempotency_header: str = IDEMPOTENCY_HEADER,
+):
+    """
+    :param distributed: 是否跨 worker 合并相同的请求, 默认为 SINGLE_FLIGHT_DISTRIBUTED
+    :param idempotent: 是否在 redis 中保存执行结果, 之后相同的请求 (包括其他 worker 上的) 直接返回保存的结果
+    :param idempotency_ttl: 执行结果的保留秒数, 默认为 IDEMPOTENCY_TTL
+    :param idempotency_header: 幂等键所在的请求头, 请求头不存在时使用请求体生成幂等键
+    """
+    if func is None:
+        return functools.partial(
+            only_one_exec_decorate, distributed=distributed, idempotent=idempotent,
+            idempotency_ttl=idempotency_ttl, idempotency_header=idempotency_header
+        )
+
+    use_distributed = SINGLE_FLIGHT_DISTRIBUTED if distributed is None else distributed
+
+    async def exec_func(cache_key, args, kwargs):
+        if not idempotent:
+            return await run_func(cache_key, func, args, kwargs, use_distributed)
+        return await idempotency_store.run(
+            cache_key,
+            lambda: run_func(cache_key, func, args, kwargs, use_distributed),
+            ttl=idempotency_ttl,
+        )
+
     @functools.wraps(func)
     async def wrap(cls_name, *args, **kwargs):
-        cache_key = cache.get_key(kwargs.get("request_body"), func, cls_name)
+        if idempotent:
+            cache_key = get_idempotency_key(kwargs.get("request_body"), func, cls_name, idempotency_header)
+        else:
+            cache_key = cache.get_key(kwargs.get("request_body"), func, cls_name)
 
         e_list_length = len(e_list[cache_key])
 
@@ -150,9 +831,12 @@ def only_one_exec_decorate(func):
 
         if e_list_length == 0 and len(e_list[cache_key]) == 1:
             async def get_result():
-                result = await func(*args, **kwargs)
-                while e_list[cache_key]:
-                    e_list[cache_key].pop().set_val(result)
+                try:
+                    result = await exec_func(cache_key, args, kwargs)
+                except Exception as e:
+                    wake_events(cache_key, exc=e)
+                    return
+                wake_events(cache_key, result)
 
             _task = asyncio.create_task(get_result())
 
@@ -1,42 +1,234 @@
 # -*- encoding: utf-8 -*-
 
+import re
+import time
+import pickle
+import asyncio
+import hashlib
+import traceback
+
 from sqlalchemy import event
+from sqlalchemy.orm import Mapper
+from sqlalchemy.orm.loading import merge_frozen_result
 from sqlalchemy.sql import Select, Update, Delete, Insert
+from sqlalchemy.sql.expression import TableClause
 from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.sql.util import find_tables
+
+from src.core import (
+    dao_log,
+    Histogram,
+    current_sql_stats,
+    SQL_SLOW_THRESHOLD_MS,
+    SQL_LOG_MAX_LENGTH,
+    CACHE_L2_ENABLED,
+    QUERY_CACHE_TTL,
+    QUERY_CACHE_MAX_SIZE,
+    QUERY_CACHE_ENABLED,
+)
+from src.db import pg_async_engine, pg_read_async_engine, RoutingSession
+from .cache_decorate import cache, publish_invalidation
+
+# 所有 SQL 的耗时分布
+sql_latency = Histogram()
+sql_slow_count = 0
+
+_space_re = re.compile(r"\s+")
+
+
+def normalize_statement(statement: str) -> str:
+    """合并空白字符并截断, 参数已经是占位符, 相同结构的语句得到相同的结果"""
+    statement = _space_re.sub(" ", statement).strip()
+    if len(statement) > SQL_LOG_MAX_LENGTH:
+        statement = statement[:SQL_LOG_MAX_LENGTH] + "..."
+    return statement
+
+
+def get_sql_status() -> dict:
+    return {"latency": sql_latency.to_dict(), "slow_count": sql_slow_count}
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # 嵌套执行时使用栈保存开始时间
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    global sql_slow_count
+
+    start_times = conn.info.get("query_start_time")
+    if not start_times:
+        return
+    used_time = time.perf_counter() - start_times.pop()
+    # asyncpg 的 SELECT 也会从状态信息中解析出行数, 拿不到时为 -1
+    rows = cursor.rowcount
+    sql_latency.observe(used_time)
+
+    stats = current_sql_stats.get()
+    if stats is not None:
+        stats.add(used_time, rows)
+
+    if used_time * 1000 >= SQL_SLOW_THRESHOLD_MS:
+        sql_slow_count += 1
+        dao_log.warning(
+            f"Slow query used {used_time * 1000:.2f}ms, rows {rows}, "
+            f"executemany {executemany}: {normalize_statement(statement)}"
+        )
+
+
+def handle_error(exception_context):
+    # 出错时不会触发 after_cursor_execute, 丢弃开始时间
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_start_time"):
+        conn.info["query_start_time"].pop()
+
+
+# 异步引擎不支持直接监听, 需要监听对应的同步引擎, 只读引擎可能和主库是同一个
+for _engine in {id(e): e for e in (pg_async_engine, pg_read_async_engine)}.values():
+    event.listen(_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(_engine.sync_engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(_engine.sync_engine, "handle_error", handle_error)
+
+
+# 查询结果缓存
+#   1. 语句设置 execution_options(query_cache=True) 或 query_cache=<ttl 秒> 时才缓存, 结果保存在进程内 cache 中
+#   2. 缓存 key 为编译后的 SQL 加参数, 条目带上语句读取的表 table:<name> 标签
+#   3. after_execute 和 mapper 事件发现写操作时, 立即失效对应表的缓存, 事务提交后再失效一次
+#       避免并发请求在提交前把旧数据重新写入缓存
+#   4. 无法判断表的 text 写语句会失效所有 table: 标签, 即所有查询缓存, 不影响其他缓存
+
+_select_prefixes = ("SELECT", "WITH", "EXPLAIN", "SHOW", "VALUES")
+# 保存异步失效任务的引用, 避免任务被回收
+_invalidate_tasks = set()
+
+
+def get_table_tags(tables) -> set:
+    return {f"table:{table.name}" for table in tables}
+
+
+def invalidate_all_tables() -> None:
+    # 只失效查询缓存, 不影响接口缓存等其他条目
+    cache.invalidate_prefix("table:")
+
+
+def get_query_cache_key(statement, parameters) -> str:
+    compiled = statement.compile(dialect=pg_async_engine.dialect)
+    params = {**compiled.params, **(parameters or {})}
+    raw = f"{compiled.string}:{sorted(params.items(), key=lambda item: item[0])!r}"
+    return "query:" + hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+
+
+def do_orm_execute(orm_execute_state):
+    ttl = orm_execute_state.execution_options.get("query_cache")
+    if not QUERY_CACHE_ENABLED or not ttl or not orm_execute_state.is_select:
+        return None
+
+    # session 中有未提交的写操作时, 查询结果可能包含未提交的数据, 不使用缓存
+    session = orm_execute_state.session
+    if session.info.get("use_primary") or session.new or session.dirty or session.deleted:
+        return None
+    statement = orm_execute_state.statement
+    if getattr(statement, "_for_update_arg", None) is not None:
+        return None
+    tags = get_table_tags(
+        table for table in find_tables(statement, check_columns=True, include_aliases=True, include_joins=True)
+        if isinstance(table, TableClause)
+    )
+    if not tags:
+        return None
+
+    try:
+        cache_key = get_query_cache_key(statement, orm_execute_state.parameters)
+    except Exception:
+        dao_log.error(f"query cache compile statement error: {traceback.format_exc()}")
+        return None
+
+    raw = cache.get(cache_key)
+    if raw is not None:
+        frozen_result = pickle.loads(raw)
+    else:
+        tag_version = cache.get_tag_version(tags)
+        frozen_result = orm_execute_state.invoke_statement().freeze()
+        try:
+            cache.set(
+                cache_key,
+                pickle.dumps(frozen_result),
+                ttl=QUERY_CACHE_TTL if ttl is True else ttl,
+                max_size=QUERY_CACHE_MAX_SIZE,
+                tags=tags,
+                tag_version=tag_version,
+            )
+        except Exception:
+            dao_log.error(f"query cache set error: {traceback.format_exc()}")
+
+    # 把缓存中的 ORM 对象合并到当前 session, 不重新查询数据库
+    return merge_frozen_result(session, statement, frozen_result, load=False)()
+
+
+def invalidate_tables(conn, tags: set | None) -> None:
+    """
+    立即失效本地缓存, 并记录到连接上, 事务提交后再次失效
+    :param tags: None 表示无法判断修改了哪些表
+    """
+    modified = conn.info.setdefault("modified_tables", set())
+    if tags is None:
+        invalidate_all_tables()
+        modified.add(None)
+    else:
+        cache.invalidate_tags(tags)
+        modified.update(tags)
+
+
+def after_execute(conn, clause_element, multi_params, params, execution_options, result):
+    if isinstance(clause_element, (Insert, Update, Delete)):
+        invalidate_tables(conn, get_table_tags([clause_element.table]))
+    elif isinstance(clause_element, (TextClause, str)):
+        text = clause_element.text if isinstance(clause_element, TextClause) else clause_element
+        if not text.lstrip().upper().startswith(_select_prefixes):
+            invalidate_tables(conn, None)
+
+
+def after_flush(mapper, connection, target):
+    # 和 after_execute 重复, 用于覆盖继承映射等一个对象对应多张表的情况
+    invalidate_tables(connection, get_table_tags(mapper.tables))
+
+
+def after_commit(conn):
+    # dao.bulk_copy 等绕过 SQLAlchemy 的写操作也会把表名记录到 modified_tables 中
+    modified = conn.info.pop("modified_tables", None)
+    if not modified:
+        return
+    all_tables = None in modified
+    tags = [tag for tag in modified if tag is not None]
+    if all_tables:
+        invalidate_all_tables()
+    else:
+        cache.invalidate_tags(tags)
+    # table: 标签只有查询缓存使用, 关闭查询缓存时其他 worker 没有需要失效的条目
+    if not CACHE_L2_ENABLED or not QUERY_CACHE_ENABLED:
+        return
+    # 通知其他 worker 失效各自的本地缓存, 事件中不能 await, 创建任务异步执行
+    # 查询缓存只在本地, redis 二级缓存中没有 table: 标签, 只广播, 不执行二级缓存的失效脚本
+    # 无法判断修改了哪些表时, 只广播 table: 前缀
+    try:
+        task = asyncio.get_running_loop().create_task(
+            publish_invalidation(tags, tag_prefix="table:" if all_tables else None)
+        )
+    except RuntimeError:
+        return
+    _invalidate_tasks.add(task)
+    task.add_done_callback(_invalidate_tasks.discard)
+
+
+def after_rollback(conn):
+    conn.info.pop("modified_tables", None)
+
+
+for _engine in {id(e): e for e in (pg_async_engine, pg_read_async_engine)}.values():
+    event.listen(_engine.sync_engine, "after_execute", after_execute)
+    event.listen(_engine.sync_engine, "commit", after_commit)
+    event.listen(_engine.sync_engine, "rollback", after_rollback)
 
-from src.db import pg_async_engine
-
-
-# @event.listens_for(pg_async_engine, 'before_execute', retval=True)
-# def before_execute(conn, clause_element, multi_params, params, execution_options):
-#     # <sqlalchemy.engine.base.Connection object at 0x1033fe150> <class 'sqlalchemy.engine.base.Connection'>
-#     # INSERT INTO persons (id, name) VALUES (:id, :name) <class 'sqlalchemy.sql.dml.Insert'>
-#     # [{'name': 'John'}, {'name': 'Alice'}] <class 'list'>
-#     # {} <class 'dict'>
-#     if isinstance(clause_element, Select):
-#         # 执行查询缓存操作
-#         return
-
-
-# @event.listens_for(pg_async_engine, 'after_execute')
-# def after_execute(conn, clause_element, multi_params, params, execution_options, result, **kwargs):
-#     # <sqlalchemy.engine.base.Connection object at 0x1078f5d10> <class 'sqlalchemy.engine.base.Connection'>
-#     # INSERT INTO persons (id, name) VALUES (:id, :name) <class 'sqlalchemy.sql.dml.Insert'>
-#     # [{'name': 'John'}, {'name': 'Alice'}] <class 'list'>
-#     # {} <class 'dict'>
-#     # <sqlalchemy.engine.cursor.CursorResult object at 0x107843d90> <class 'sqlalchemy.engine.cursor.CursorResult'>
-#     # {}
-#     for cls in [Insert, Update, Delete, TextClause]:
-#         if isinstance(clause_element, cls):
-#             # 执行数据更新后的操作
-#             pass
-
-# @event.listens_for(Container_data, "after_insert")
-# @event.listens_for(Container_data, "after_delete")
-# @event.listens_for(Container_data, "after_update")
-# def after_flush(mapper, connection, target):
-#     # Mapper[Container_data(container_data)] <class 'sqlalchemy.orm.mapper.Mapper'>
-#     # <sqlalchemy.engine.base.Connection object at 0x110477710> <class 'sqlalchemy.engine.base.Connection'>
-#     # <src.db.models.container_data.Container_data object at 0x10fe57810> <class 'src.db.models.container_data.Container_data'>
-#     # 执行数据更新后的操作
-#     pass
+event.listen(RoutingSession, "do_orm_execute", do_orm_execute)
+for _identifier in ("after_insert", "after_update", "after_delete"):
+    event.listen(Mapper, _identifier, after_flush)
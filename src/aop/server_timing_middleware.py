@@ -0,0 +1,34 @@
+# -*- encoding: utf-8 -*-
+
+from fastapi import Request
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from src.core import f_log, SqlStats, current_sql_stats, SQL_REQUEST_MAX_QUERIES
+
+
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Server-Timing
+class ServerTimingMiddleware(BaseHTTPMiddleware):
+    """
+    统计每个请求执行的 SQL 数量和总耗时, 写入 Server-Timing 响应头
+        Server-Timing: db;dur=12.34;desc="5 queries, 20 rows"
+    流式响应在发送响应头之后执行的 SQL 不会被统计
+    """
+
+    async def dispatch(self, request: Request, call_next):
+        stats = SqlStats()
+        token = current_sql_stats.set(stats)
+        try:
+            response = await call_next(request)
+        finally:
+            current_sql_stats.reset(token)
+
+        response.headers.append(
+            "Server-Timing",
+            f'db;dur={stats.duration * 1000:.2f};desc="{stats.count} queries, {stats.rows} rows"'
+        )
+        if 0 < SQL_REQUEST_MAX_QUERIES < stats.count:
+            f_log.warning(
+                f"Request {request.url.path} {request.method} executed {stats.count} queries, "
+                f"used {stats.duration * 1000:.2f}ms, maybe N+1 query"
+            )
+        return response
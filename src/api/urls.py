@@ -20,7 +20,22 @@ route_list = [
         ApiView,
         {
             "summary": "api summary", "desc": "api desc",
-            "method_decorator": {"post": clear_cache_decorator}
+            "method_decorator": {"post": clear_cache_decorator(tags=["ApiView:get"])},
+            "etag": True,
+        },
+    ),
+    (
+        "/instrumentation",
+        InstrumentationView,
+        {
+            "summary": "instrumentation", "desc": "connection pool and runtime statistics",
+        },
+    ),
+    (
+        "/api/record/export",
+        RecordExportView,
+        {
+            "summary": "record export", "desc": "stream records as ndjson or csv",
         },
     ),
     (
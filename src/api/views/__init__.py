@@ -1,2 +1,4 @@
 from .api_view import *
-from .api_websocket import *
\ No newline at end of file
+from .api_websocket import *
+from .instrumentation_view import *
+from .record_export_view import *
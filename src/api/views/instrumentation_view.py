@@ -0,0 +1,16 @@
+# -*- encoding: utf-8 -*-
+
+from src.oop.api_view_base import BaseApiView
+from src.db import get_pg_pool_status
+from src.aop.orm_listen import get_sql_status
+from src.utils import client_cache
+from src.schema import StdRes
+
+
+class InstrumentationView(BaseApiView):
+    async def get(self):
+        return StdRes(data={
+            "pg_pool": get_pg_pool_status(),
+            "sql": get_sql_status(),
+            "redis_client_cache": client_cache.get_status(),
+        })
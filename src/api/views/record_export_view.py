@@ -0,0 +1,18 @@
+# -*- encoding: utf-8 -*-
+
+from typing import Literal
+
+from src.oop.api_view_base import BaseApiView
+from src.db import pg_sessionmaker
+from src.db.dao import dao
+from src.db.model.record import Record
+
+
+class RecordExportView(BaseApiView):
+    async def get(self, fmt: Literal["ndjson", "csv"] = "ndjson"):
+        async def rows():
+            async with pg_sessionmaker() as session:
+                async for record in dao.stream_select(Record, (), session, mappings=True):
+                    yield record
+
+        return self.stream_response(rows(), fmt=fmt, filename=f"record.{fmt}")
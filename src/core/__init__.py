@@ -1,2 +1,4 @@
 from .config import *
-from .log import *
\ No newline at end of file
+from .log import *
+from .context import *
+from .metrics import *
@@ -21,6 +21,38 @@ PG_URL: str = config(
     cast=str,
     default=f"postgresql+asyncpg://postgres:postgres@/inventory?target_session_attrs=read-write&host=127.0.0.1:5531&host=127.0.0.1:5532&host=127.0.0.1:5533"
 )
+# 只读连接, 默认和 PG_URL 使用相同的多个 host, 优先连接备库, 没有可用备库时连接主库
+PG_READ_URL: str = config(
+    "PG_READ_URL",
+    cast=str,
+    default=PG_URL.replace("target_session_attrs=read-write", "target_session_attrs=prefer-standby")
+)
+# 流式查询时服务端游标每次读取的行数
+DAO_STREAM_FETCH_SIZE: int = config("DAO_STREAM_FETCH_SIZE", cast=int, default=1000)
+# 按 key 列表查询、更新、删除时, 每条语句数组参数的最大长度
+DAO_ARRAY_CHUNK_SIZE: int = config("DAO_ARRAY_CHUNK_SIZE", cast=int, default=10000)
+# 慢查询日志的阈值, 单位 ms
+SQL_SLOW_THRESHOLD_MS: float = config("SQL_SLOW_THRESHOLD_MS", cast=float, default=200)
+# 单个请求执行的 SQL 超过该数量时记录警告, 用于发现 N+1 查询, 0 表示不检查
+SQL_REQUEST_MAX_QUERIES: int = config("SQL_REQUEST_MAX_QUERIES", cast=int, default=50)
+# 日志中 SQL 语句的最大长度
+SQL_LOG_MAX_LENGTH: int = config("SQL_LOG_MAX_LENGTH", cast=int, default=2000)
+# update_with_retry 版本冲突时的最大重试次数, 以及第一次重试前的等待秒数, 之后每次翻倍
+DAO_CAS_MAX_RETRIES: int = config("DAO_CAS_MAX_RETRIES", cast=int, default=3)
+DAO_CAS_RETRY_BACKOFF: float = config("DAO_CAS_RETRY_BACKOFF", cast=float, default=0.005)
+# 合并并发单行插入, 每批最多的行数和最长等待秒数
+BATCH_INSERT_MAX_SIZE: int = config("BATCH_INSERT_MAX_SIZE", cast=int, default=500)
+BATCH_INSERT_MAX_DELAY: float = config("BATCH_INSERT_MAX_DELAY", cast=float, default=0.005)
+# 连接池, 主库和只读引擎各自使用一个连接池
+PG_POOL_SIZE: int = config("PG_POOL_SIZE", cast=int, default=10)
+PG_MAX_OVERFLOW: int = config("PG_MAX_OVERFLOW", cast=int, default=10)
+# 获取连接的超时秒数
+PG_POOL_TIMEOUT: float = config("PG_POOL_TIMEOUT", cast=float, default=30)
+# 连接的最长使用秒数, -1 表示不回收
+PG_POOL_RECYCLE: int = config("PG_POOL_RECYCLE", cast=int, default=1800)
+PG_POOL_PRE_PING: bool = config("PG_POOL_PRE_PING", cast=bool, default=True)
+# 启动时预先建立的连接数量
+PG_POOL_MIN_SIZE: int = config("PG_POOL_MIN_SIZE", cast=int, default=2)
 
 # redis config
 REDIS_CONNECT_TYPE = config("REDIS_CONNNECT_TYPE", cast=str, default="redis")
@@ -30,6 +62,63 @@ REDIS_DB: int = config("REDIS_DB", cast=int, default=0)
 REDIS_PASSWORD: int = config("REDIS_PASSWORD", cast=str, default="")
 REDIS_SENTINELS: str = config("REDIS_SENTINELS", cast=str, default="127.0.0.1,46380;127.0.0.1,46381;127.0.0.1,46382")
 REDIS_SENTINEL_MASTER: str = config("REDIS_SENTINEL_MASTER", cast=str, default="master")
+# 哨兵模式下 XREAD 等阻塞读取使用从库, 从库出错后 REDIS_REPLICA_RETRY_INTERVAL 秒内改用主库
+REDIS_READ_FROM_REPLICA: bool = config("REDIS_READ_FROM_REPLICA", cast=bool, default=True)
+REDIS_REPLICA_RETRY_INTERVAL: float = config("REDIS_REPLICA_RETRY_INTERVAL", cast=float, default=10)
+# 连接池, 连接数达到上限时最多等待 REDIS_POOL_TIMEOUT 秒
+REDIS_MAX_CONNECTIONS: int = config("REDIS_MAX_CONNECTIONS", cast=int, default=50)
+REDIS_POOL_TIMEOUT: float = config("REDIS_POOL_TIMEOUT", cast=float, default=5)
+# 单位秒, 需要大于 XREAD 等阻塞命令的 block 时间
+REDIS_SOCKET_TIMEOUT: float = config("REDIS_SOCKET_TIMEOUT", cast=float, default=5)
+REDIS_SOCKET_CONNECT_TIMEOUT: float = config("REDIS_SOCKET_CONNECT_TIMEOUT", cast=float, default=2)
+REDIS_SOCKET_KEEPALIVE: bool = config("REDIS_SOCKET_KEEPALIVE", cast=bool, default=True)
+# 连接空闲超过该秒数后, 使用前先发送 PING 检查
+REDIS_HEALTH_CHECK_INTERVAL: int = config("REDIS_HEALTH_CHECK_INTERVAL", cast=int, default=30)
+# 自动 pipeline 单批最多的命令数量
+REDIS_AUTO_PIPELINE_MAX_BATCH: int = config("REDIS_AUTO_PIPELINE_MAX_BATCH", cast=int, default=200)
+# 客户端缓存, 需要 redis 6+, 只缓存匹配前缀的 key, 服务端通过 CLIENT TRACKING 通知失效
+REDIS_CLIENT_CACHE_ENABLED: bool = config("REDIS_CLIENT_CACHE_ENABLED", cast=bool, default=False)
+REDIS_CLIENT_CACHE_PREFIXES: List[str] = config(
+    "REDIS_CLIENT_CACHE_PREFIXES", cast=CommaSeparatedStrings, default=["config:"]
+)
+REDIS_CLIENT_CACHE_MAX_ENTRIES: int = config("REDIS_CLIENT_CACHE_MAX_ENTRIES", cast=int, default=10000)
 
 # websocket broadcaster
-BROADCASTER_TYPE = config("BROADCASTER_TYPE", cast=str, default="redis")
\ No newline at end of file
+BROADCASTER_TYPE = config("BROADCASTER_TYPE", cast=str, default="redis")
+
+# cache config
+CACHE_MAX_ENTRIES: int = config("CACHE_MAX_ENTRIES", cast=int, default=10000)
+CACHE_MAX_BYTES: int = config("CACHE_MAX_BYTES", cast=int, default=64 * 1024 * 1024)
+# 单位秒, 0 表示永不过期
+CACHE_DEFAULT_TTL: float = config("CACHE_DEFAULT_TTL", cast=float, default=300)
+# 使用 redis 作为多个 worker 共享的二级缓存, 并通过 redis streams 广播失效事件
+CACHE_L2_ENABLED: bool = config("CACHE_L2_ENABLED", cast=bool, default=False)
+CACHE_REDIS_PREFIX: str = config("CACHE_REDIS_PREFIX", cast=str, default="cache")
+# 二级缓存条目的最长过期秒数, 标签集合的过期时间也使用该值
+CACHE_REDIS_MAX_TTL: int = config("CACHE_REDIS_MAX_TTL", cast=int, default=24 * 3600)
+CACHE_INVALIDATE_TOPIC: str = config("CACHE_INVALIDATE_TOPIC", cast=str, default="cache_invalidate")
+# 查询结果缓存, 语句设置 execution_options(query_cache=True) 时使用的默认过期秒数, 以及单条结果的最大字节数
+QUERY_CACHE_TTL: float = config("QUERY_CACHE_TTL", cast=float, default=60)
+QUERY_CACHE_MAX_SIZE: int = config("QUERY_CACHE_MAX_SIZE", cast=int, default=1024 * 1024)
+# 关闭后忽略 query_cache 选项, 开启二级缓存时也不再为每次写操作广播表的失效事件
+QUERY_CACHE_ENABLED: bool = config("QUERY_CACHE_ENABLED", cast=bool, default=True)
+
+# 跨 worker 的 single-flight, 相同的请求只由一个 worker 执行
+SINGLE_FLIGHT_DISTRIBUTED: bool = config("SINGLE_FLIGHT_DISTRIBUTED", cast=bool, default=False)
+SINGLE_FLIGHT_PREFIX: str = config("SINGLE_FLIGHT_PREFIX", cast=str, default="single_flight")
+# leader 锁的过期时间, 单位 ms, leader 异常退出后 follower 最多等待这么久
+SINGLE_FLIGHT_LOCK_TIMEOUT: int = config("SINGLE_FLIGHT_LOCK_TIMEOUT", cast=int, default=30 * 1000)
+# leader 结果在 redis 中保留的时间, 单位 ms
+SINGLE_FLIGHT_RESULT_TTL: int = config("SINGLE_FLIGHT_RESULT_TTL", cast=int, default=10 * 1000)
+
+# 回调接口的幂等键
+IDEMPOTENCY_PREFIX: str = config("IDEMPOTENCY_PREFIX", cast=str, default="idempotency")
+IDEMPOTENCY_HEADER: str = config("IDEMPOTENCY_HEADER", cast=str, default="Idempotency-Key")
+# 已完成请求的结果保留秒数
+IDEMPOTENCY_TTL: int = config("IDEMPOTENCY_TTL", cast=int, default=24 * 3600)
+# 执行中状态的过期时间, 单位 ms, 执行者异常退出后重复请求最多等待这么久
+IDEMPOTENCY_LOCK_TIMEOUT: int = config("IDEMPOTENCY_LOCK_TIMEOUT", cast=int, default=60 * 1000)
+
+# 缓存预热, 启动时并发执行的请求数量和总超时秒数
+CACHE_WARMUP_CONCURRENCY: int = config("CACHE_WARMUP_CONCURRENCY", cast=int, default=4)
+CACHE_WARMUP_TIMEOUT: float = config("CACHE_WARMUP_TIMEOUT", cast=float, default=60)
@@ -0,0 +1,12 @@
+# -*- encoding: utf-8 -*-
+
+from contextvars import ContextVar
+
+from starlette.requests import Request
+
+from .metrics import SqlStats
+
+# 当前请求, 由 LogReqContextRoute 设置, 供装饰器等拿不到 Request 参数的地方使用
+current_request: ContextVar[Request | None] = ContextVar("current_request", default=None)
+# 当前请求的 SQL 统计, 由 ServerTimingMiddleware 设置, orm_listen 中的事件累加
+current_sql_stats: ContextVar[SqlStats | None] = ContextVar("current_sql_stats", default=None)
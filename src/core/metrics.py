@@ -0,0 +1,59 @@
+# -*- encoding: utf-8 -*-
+
+import bisect
+from typing import Sequence
+
+# 单位秒
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class SqlStats(object):
+    """单个请求执行的 SQL 数量和总耗时"""
+
+    __slots__ = ("count", "duration", "rows")
+
+    def __init__(self) -> None:
+        self.count = 0
+        # 单位秒
+        self.duration = 0.0
+        self.rows = 0
+
+    def add(self, duration: float, rows: int) -> None:
+        self.count += 1
+        self.duration += duration
+        self.rows += max(rows, 0)
+
+
+class Histogram(object):
+    """
+    简单的直方图, 用于记录耗时分布, 只在事件循环中使用, 不需要加锁
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        # 最后一个桶记录大于所有边界的值
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def to_dict(self) -> dict:
+        """累积计数, le_x 表示小于等于 x 的数量"""
+        buckets, total = {}, 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            buckets[f"le_{bound}"] = total
+        buckets["le_inf"] = self.count
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "avg": round(self.sum / self.count, 6) if self.count else 0,
+            "max": round(self.max, 6),
+            "buckets": buckets,
+        }
@@ -1,21 +1,174 @@
 # -*- encoding: utf-8 -*-
 
 
+import time
+import asyncio
 from typing import AsyncGenerator
 
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.sql import Select
 
-from src.core import PG_URL
+from src.core import (
+    PG_URL,
+    PG_READ_URL,
+    PG_POOL_SIZE,
+    PG_MAX_OVERFLOW,
+    PG_POOL_TIMEOUT,
+    PG_POOL_RECYCLE,
+    PG_POOL_PRE_PING,
+    PG_POOL_MIN_SIZE,
+    dao_log,
+    Histogram,
+)
+
+
+class InstrumentedAsyncPool(AsyncAdaptedQueuePool):
+    """
+    记录获取连接耗时的连接池, 用于区分连接池排队和慢查询
+        checkout_wait: 在队列中等待空闲连接的时间, 不包括新建连接
+        connect_time: 新建连接 (连接加认证) 的时间
+    QueuePool._do_get 会递归调用自己, 这里不包装 _do_get, 而是包装队列的 get 和 _create_connection
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkout_wait = Histogram()
+        self.connect_time = Histogram()
+        queue_get = self._pool.get
+
+        def timed_get(block=True, timeout=None):
+            start_time = time.perf_counter()
+            try:
+                connection = queue_get(block, timeout)
+            except Exception:
+                # 不等待的尝试失败后会改为新建连接, 只记录真正等待过的超时
+                if block:
+                    self.checkout_wait.observe(time.perf_counter() - start_time)
+                raise
+            self.checkout_wait.observe(time.perf_counter() - start_time)
+            return connection
+
+        self._pool.get = timed_get
+
+    def _create_connection(self):
+        start_time = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            self.connect_time.observe(time.perf_counter() - start_time)
+
+
+def new_engine(url: str) -> AsyncEngine:
+    return create_async_engine(
+        url=url,
+        poolclass=InstrumentedAsyncPool,
+        pool_size=PG_POOL_SIZE,
+        max_overflow=PG_MAX_OVERFLOW,
+        pool_timeout=PG_POOL_TIMEOUT,
+        pool_recycle=PG_POOL_RECYCLE,
+        pool_pre_ping=PG_POOL_PRE_PING,
+    )
+
+
+pg_async_engine = new_engine(PG_URL)
+
+# 只读引擎, PG_READ_URL 和 PG_URL 相同时直接使用主库引擎
+pg_read_async_engine = (
+    new_engine(PG_READ_URL) if PG_READ_URL and PG_READ_URL != PG_URL else pg_async_engine
+)
+
+
+def get_pool_status(engine: AsyncEngine) -> dict:
+    pool = engine.sync_engine.pool
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "checkout_wait": pool.checkout_wait.to_dict(),
+        "connect_time": pool.connect_time.to_dict(),
+    }
+
+
+def get_pg_pool_status() -> dict:
+    status = {"primary": get_pool_status(pg_async_engine)}
+    if pg_read_async_engine is not pg_async_engine:
+        status["replica"] = get_pool_status(pg_read_async_engine)
+    return status
+
+
+async def warmup_pg_pool(size: int = PG_POOL_MIN_SIZE) -> None:
+    """启动时预先建立连接, 同时持有 size 个连接, 释放后留在连接池中"""
+    engines = {id(pg_async_engine): pg_async_engine, id(pg_read_async_engine): pg_read_async_engine}
+    for engine in engines.values():
+        start_time = time.perf_counter()
+        results = await asyncio.gather(
+            *(engine.connect().start() for _ in range(min(size, PG_POOL_SIZE))),
+            return_exceptions=True,
+        )
+        opened = 0
+        for conn in results:
+            if isinstance(conn, Exception):
+                dao_log.error(f"warmup pg pool error: {conn!r}")
+                continue
+            opened += 1
+            await conn.close()
+        dao_log.info(
+            f"warmup pg pool {engine.url.render_as_string(hide_password=True)} opened {opened} connections, "
+            f"used {time.perf_counter() - start_time:.2f}s"
+        )
+
+
+class RoutingSession(Session):
+    """
+    读写分离的 session
+        1. 只读的 SELECT 路由到备库
+        2. 写操作、flush、SELECT ... FOR UPDATE 以及 text 语句路由到主库
+        3. session 中发生过写操作后, 之后的语句都使用主库, 保证读到自己的写入
+        4. 语句设置 execution_options(use_primary=True), 或者 session.info["use_primary"] = True 时强制使用主库
+        5. 只读的 text 语句可以设置 execution_options(use_replica=True) 使用备库
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if (
+                clause is not None
+                and not self.info.get("use_primary")
+                and clause.get_execution_options().get("use_replica")
+        ):
+            return pg_read_async_engine.sync_engine
+
+        if (
+                not self.info.get("use_primary")
+                and not self._flushing
+                and isinstance(clause, Select)
+                and clause._for_update_arg is None
+                and not clause.get_execution_options().get("use_primary")
+        ):
+            return pg_read_async_engine.sync_engine
+
+        self.info["use_primary"] = True
+        return pg_async_engine.sync_engine
 
-pg_async_engine =  create_async_engine(url=PG_URL)
 
 pg_sessionmaker = sessionmaker(
     pg_async_engine,
-    class_=AsyncSession
+    class_=AsyncSession,
+    sync_session_class=RoutingSession,
 )
 
 async def async_session() -> AsyncGenerator[AsyncSession, None]:
-    """session生成器 作为fastapi的Depends选项"""
+    """
+    session生成器 作为fastapi的Depends选项
+    AsyncSession 在第一次执行语句时才从连接池获取连接, 没有执行过语句时 close 也不会访问数据库,
+    提前返回的请求 (例如命中 get_cache_decorator 的缓存) 只有创建 session 对象的开销
+    """
     async with pg_sessionmaker() as session:
-        yield session
\ No newline at end of file
+        yield session
+
+
+async def async_primary_session() -> AsyncGenerator[AsyncSession, None]:
+    """所有语句都使用主库的 session, 用于需要在事务中读取最新数据的接口"""
+    async with pg_sessionmaker(info={"use_primary": True}) as session:
+        yield session
@@ -1,6 +1,11 @@
 # -*- encoding: utf-8 -*-
 
+import time
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Set
+
 from redis import asyncio as aioredis
+from redis import exceptions as redis_exceptions
 
 from src.core import (
     REDIS_CONNECT_TYPE,
@@ -10,20 +15,220 @@ from src.core import (
     REDIS_PASSWORD,
     REDIS_SENTINELS,
     REDIS_SENTINEL_MASTER,
+    REDIS_MAX_CONNECTIONS,
+    REDIS_POOL_TIMEOUT,
+    REDIS_SOCKET_TIMEOUT,
+    REDIS_SOCKET_CONNECT_TIMEOUT,
+    REDIS_SOCKET_KEEPALIVE,
+    REDIS_HEALTH_CHECK_INTERVAL,
+    REDIS_AUTO_PIPELINE_MAX_BATCH,
+    REDIS_READ_FROM_REPLICA,
+    REDIS_REPLICA_RETRY_INTERVAL,
+    f_log,
 )
 
+# 普通连接和哨兵连接共用的参数
+connection_kwargs = {
+    "password": REDIS_PASSWORD,
+    "db": REDIS_DB,
+    "socket_timeout": REDIS_SOCKET_TIMEOUT,
+    "socket_connect_timeout": REDIS_SOCKET_CONNECT_TIMEOUT,
+    "socket_keepalive": REDIS_SOCKET_KEEPALIVE,
+    "health_check_interval": REDIS_HEALTH_CHECK_INTERVAL,
+}
 
 redis_db: aioredis.Redis = None
+# 只读 client, 哨兵模式下连接从库, 其他情况和 redis_db 相同
+redis_read_db: aioredis.Redis = None
 
 match REDIS_CONNECT_TYPE:
     case "redis":
-        redis_db = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, password=REDIS_PASSWORD)
+        # 连接数达到上限时等待空闲连接, 默认的 ConnectionPool 会直接抛出 Too many connections
+        redis_db = aioredis.Redis(
+            connection_pool=aioredis.BlockingConnectionPool(
+                host=REDIS_HOST,
+                port=REDIS_PORT,
+                max_connections=REDIS_MAX_CONNECTIONS,
+                timeout=REDIS_POOL_TIMEOUT,
+                **connection_kwargs,
+            )
+        )
+        redis_read_db = redis_db
     case "redis_sentinel":
-        redis_db = aioredis.sentinel.Sentinel(
-            [hp.split(',') for hp in REDIS_SENTINELS.split(";")]
-        ).master_for(
+        sentinel = aioredis.sentinel.Sentinel(
+            [hp.split(',') for hp in REDIS_SENTINELS.split(";")],
+            sentinel_kwargs={
+                "socket_timeout": REDIS_SOCKET_TIMEOUT,
+                "socket_connect_timeout": REDIS_SOCKET_CONNECT_TIMEOUT,
+            },
+        )
+        redis_db = sentinel.master_for(
             REDIS_SENTINEL_MASTER,
-            **{"password": REDIS_PASSWORD, "port": REDIS_PORT, "db": REDIS_DB}
+            **{"port": REDIS_PORT, "max_connections": REDIS_MAX_CONNECTIONS, **connection_kwargs}
         )
+        # 从库连接池在多个从库之间轮询, 没有可用从库时连接主库
+        redis_read_db = sentinel.slave_for(
+            REDIS_SENTINEL_MASTER,
+            **{"port": REDIS_PORT, "max_connections": REDIS_MAX_CONNECTIONS, **connection_kwargs}
+        ) if REDIS_READ_FROM_REPLICA else redis_db
     case _:
         raise ValueError("REDIS_CONNECT_TYPE must be redis or redis_sentinel")
+
+
+class RedisReadRouter(object):
+    """
+    只读命令的路由
+        1. 默认使用从库, 从库连接出错或超时后, retry_interval 秒内改用主库, 之后再尝试从库
+        2. 从库的数据可能落后于主库, 需要读到自己写入的场景应直接使用 redis_db,
+            如二级缓存 (失效后从库的旧值会被重新写入本地缓存)、single-flight 的结果、幂等键和锁
+
+    async def handler():
+        value = await redis_read_router.execute(lambda client: client.get("key"))
+    """
+
+    def __init__(
+            self,
+            master: aioredis.Redis,
+            replica: aioredis.Redis,
+            retry_interval: float = REDIS_REPLICA_RETRY_INTERVAL,
+    ):
+        self.master = master
+        self.replica = replica
+        self.retry_interval = retry_interval
+        self.replica_failed_at = 0.0
+
+    @property
+    def client(self) -> aioredis.Redis:
+        if self.replica is self.master or time.monotonic() - self.replica_failed_at < self.retry_interval:
+            return self.master
+        return self.replica
+
+    def mark_failed(self, client: aioredis.Redis) -> None:
+        """client 出错后调用, 是从库时暂时改用主库"""
+        if client is self.replica and client is not self.master:
+            self.replica_failed_at = time.monotonic()
+            f_log.warning(f"redis replica unavailable, read from master in the next {self.retry_interval}s")
+
+    def get_client(self, client: aioredis.Redis) -> aioredis.Redis:
+        """client 是 redis_db 时返回当前的只读 client, 调用方自己传入的 client 保持不变"""
+        return self.client if client is self.master else client
+
+    async def execute(self, func: Callable[[aioredis.Redis], Awaitable]) -> Any:
+        client = self.client
+        try:
+            return await func(client)
+        except (redis_exceptions.ConnectionError, redis_exceptions.TimeoutError):
+            if client is self.master:
+                raise
+            self.mark_failed(client)
+            return await func(self.master)
+
+
+redis_read_router = RedisReadRouter(redis_db, redis_read_db)
+
+
+class AutoPipeline(object):
+    """
+    自动 pipeline, 同一轮事件循环中发出的命令合并为一个 pipeline 发送, 多个命令只需要一次网络往返
+    每个调用方得到自己命令的结果或异常, 和直接调用 redis_db 的命令一样
+
+    async def handler():
+        pipe = get_auto_pipeline()
+        # 两个命令在同一个 pipeline 中发送
+        value, pttl = await asyncio.gather(pipe.get("key"), pipe.pttl("key"))
+    """
+
+    def __init__(self, client: aioredis.Redis, max_batch: int = REDIS_AUTO_PIPELINE_MAX_BATCH):
+        self.client = client
+        self.max_batch = max_batch
+        self.pending: List[tuple[tuple, dict, asyncio.Future]] = []
+        self.flush_scheduled = False
+        # 保存发送任务的引用, 避免任务被回收
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def execute_command(self, *args, **options) -> Any:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self.pending.append((args, options, fut))
+        if len(self.pending) >= self.max_batch:
+            self._flush()
+        elif not self.flush_scheduled:
+            # 在当前已就绪的回调之后发送, 同一轮中其他任务发出的命令会进入同一批
+            self.flush_scheduled = True
+            loop.call_soon(self._flush)
+        return await fut
+
+    def _flush(self) -> None:
+        self.flush_scheduled = False
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._send(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, batch: List[tuple[tuple, dict, asyncio.Future]]) -> None:
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                for args, options, _ in batch:
+                    pipe.execute_command(*args, **options)
+                results = await pipe.execute(raise_on_error=False)
+        except Exception as exc:
+            for _, _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(exc)
+            return
+
+        for (_, _, fut), result in zip(batch, results):
+            if fut.done():
+                continue
+            if isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+
+    async def get(self, name: str) -> bytes | None:
+        return await self.execute_command("GET", name)
+
+    async def set(self, name: str, value, ex: int | None = None, px: int | None = None, nx: bool = False) -> bool | None:
+        args = ["SET", name, value]
+        if ex is not None:
+            args.extend(["EX", ex])
+        if px is not None:
+            args.extend(["PX", px])
+        if nx:
+            args.append("NX")
+        return await self.execute_command(*args)
+
+    async def pttl(self, name: str) -> int:
+        return await self.execute_command("PTTL", name)
+
+    async def exists(self, *names: str) -> int:
+        return await self.execute_command("EXISTS", *names)
+
+    async def delete(self, *names: str) -> int:
+        return await self.execute_command("DEL", *names)
+
+    async def eval(self, script: str, numkeys: int, *keys_and_args) -> Any:
+        return await self.execute_command("EVAL", script, numkeys, *keys_and_args)
+
+    async def xadd(self, name: str, fields: dict, maxlen: int | None = None, approximate: bool = True) -> bytes:
+        args = ["XADD", name]
+        if maxlen is not None:
+            args.extend(["MAXLEN", "~", maxlen] if approximate else ["MAXLEN", maxlen])
+        args.append("*")
+        for key, value in fields.items():
+            args.extend([key, value])
+        return await self.execute_command(*args)
+
+
+# client id -> 该 client 的自动 pipeline
+auto_pipelines: Dict[int, AutoPipeline] = {}
+
+
+def get_auto_pipeline(client: aioredis.Redis = None) -> AutoPipeline:
+    client = client or redis_db
+    pipe = auto_pipelines.get(id(client))
+    if pipe is None:
+        pipe = auto_pipelines[id(client)] = AutoPipeline(client)
+    return pipe
@@ -1 +1,3 @@
-from .common import *
\ No newline at end of file
+from .common import *
+from .insert_batcher import *
+from .data_loader import *
@@ -0,0 +1,80 @@
+# -*- encoding: utf-8 -*-
+"""
+对比 ORM 查询和 fetch_rows 快速查询在宽表上的耗时
+    python -m src.db.dao.benchmark --rows 10000 --columns 40 --repeat 5
+会在 PG_URL 对应的数据库中创建临时表 dao_benchmark_wide, 结束后删除
+所有查询都在主库上执行, 避免从库复制延迟导致读到的行数不完整
+"""
+
+import time
+import asyncio
+import argparse
+
+from sqlalchemy import Column, Integer, String, select
+from sqlalchemy.orm import declarative_base
+
+from src.db import pg_async_engine, pg_sessionmaker
+from src.db.dao.common import dao
+
+
+def make_wide_model(columns: int):
+    base = declarative_base()
+    attrs = {"__tablename__": "dao_benchmark_wide", "id": Column(Integer, primary_key=True)}
+    for i in range(columns):
+        attrs[f"col_{i}"] = Column(String)
+    return base, type("BenchmarkWide", (base,), attrs)
+
+
+async def timeit(name: str, repeat: int, func) -> None:
+    used_times, count = [], 0
+    for _ in range(repeat):
+        async with pg_sessionmaker(info={"use_primary": True}) as session:
+            start_time = time.perf_counter()
+            count = len(await func(session))
+            used_times.append(time.perf_counter() - start_time)
+    print(f"{name:<24} rows {count:<8} best {min(used_times) * 1000:8.2f}ms  avg {sum(used_times) / repeat * 1000:8.2f}ms")
+
+
+async def main(rows: int, columns: int, repeat: int) -> None:
+    base, model = make_wide_model(columns)
+    async with pg_async_engine.begin() as conn:
+        await conn.run_sync(base.metadata.drop_all)
+        await conn.run_sync(base.metadata.create_all)
+
+    try:
+        async with pg_sessionmaker(info={"use_primary": True}) as session:
+            count = await dao.bulk_copy(
+                model,
+                ((i, *(f"value_{i}_{j}" for j in range(columns))) for i in range(rows)),
+                session,
+                columns=["id", *(f"col_{j}" for j in range(columns))],
+            )
+            # bulk_copy 出错时由 catch 记录日志并返回 None, 不能继续对空表计时
+            if count != rows:
+                raise RuntimeError(f"bulk_copy wrote {count} rows, expected {rows}")
+            await session.commit()
+
+        async def orm_select(session):
+            return (await session.execute(select(model))).scalars().all()
+
+        await timeit("orm select", repeat, orm_select)
+        await timeit("fetch_rows tuple", repeat, lambda session: dao.select_rows(model, (), session, "tuple"))
+        await timeit("fetch_rows dict", repeat, lambda session: dao.select_rows(model, (), session, "dict"))
+
+        async def fetch_columns(session):
+            return (await dao.select_rows(model, (), session, "columns"))["id"]
+
+        await timeit("fetch_rows columns", repeat, fetch_columns)
+    finally:
+        async with pg_async_engine.begin() as conn:
+            await conn.run_sync(base.metadata.drop_all)
+        await pg_async_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--columns", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.columns, args.repeat))
@@ -8,18 +8,55 @@
 @Author  : kai.wang
 @Email   : kai.wang@westwell-lab.com
 """
-from typing import List
+import json
+import time
+import uuid
+import base64
+import random
+import asyncio
+import decimal
+import inspect
+import datetime
+from typing import Any, List, AsyncIterable, Iterable, AsyncIterator, Callable
 from contextlib import asynccontextmanager
 
 import sqlalchemy
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import ScalarResult, insert, select, update, delete
+from sqlalchemy.dialects.postgresql import insert as pg_insert, ARRAY
 from sqlalchemy.orm import selectinload, make_transient
+from sqlalchemy.orm.exc import StaleDataError
 
-from src.core import dao_log
+from src.core import (
+    dao_log,
+    DAO_STREAM_FETCH_SIZE,
+    DAO_ARRAY_CHUNK_SIZE,
+    DAO_CAS_MAX_RETRIES,
+    DAO_CAS_RETRY_BACKOFF,
+)
 
 catch = dao_log.catch
 
+# PostgreSQL 协议中单条语句最多 32767 个绑定参数
+PG_MAX_PARAMS = 32767
+
+
+def any_condition(column: sqlalchemy.Column, values: List):
+    """
+    column = ANY(:values), values 作为一个数组参数传递
+    和 column.in_(values) 不同, 不同长度的 values 生成相同的 SQL, 可以复用 asyncpg 的预编译语句和 SQLAlchemy 的编译缓存
+    """
+    return column == sqlalchemy.any_(
+        sqlalchemy.bindparam("values", list(values), type_=ARRAY(column.type), unique=True)
+    )
+
+
+def iter_key_chunks(keys: List, chunk_size: int = DAO_ARRAY_CHUNK_SIZE):
+    # 去重, 并保持原有顺序
+    keys = list(dict.fromkeys(keys))
+    for i in range(0, len(keys), chunk_size):
+        yield keys[i: i + chunk_size]
+
 
 class DatabaseAccessObjects(object):
 
@@ -30,12 +67,115 @@ class DatabaseAccessObjects(object):
             ScalarResult:
                 .first()
                 .scalar_one_or_none()
+            kwargs:
+                first: 只返回一条数据
+                use_primary: 查询使用主库, 用于读取刚写入的数据
         """
+        if kwargs.get("use_primary", False):
+            orm = orm.execution_options(use_primary=True)
         result = await session.execute(orm)
         if kwargs.get("first", False):
             return result.scalar_one_or_none()
         return result.scalars()
 
+    # 流式查询是异步生成器, 异常在迭代时抛出, 不使用 @catch
+    async def stream_scalars_by_orm(
+            self,
+            orm,
+            session: AsyncSession,
+            fetch_size: int = DAO_STREAM_FETCH_SIZE,
+            **kwargs) -> AsyncIterator:
+        """
+        使用服务端游标逐批读取 ORM 对象, 内存占用和结果集大小无关
+            kwargs:
+                mappings: 返回 RowMapping 而不是 ORM 对象
+                use_primary: 查询使用主库
+        """
+        orm = orm.execution_options(yield_per=fetch_size)
+        if kwargs.get("use_primary", False):
+            orm = orm.execution_options(use_primary=True)
+        result = await session.stream(orm)
+        rows = result.mappings() if kwargs.get("mappings", False) else result.scalars()
+        async for row in rows:
+            yield row
+
+    async def stream_select(
+            self,
+            table,
+            conditions: tuple,
+            session: AsyncSession,
+            fetch_size: int = DAO_STREAM_FETCH_SIZE,
+            **kwargs) -> AsyncIterator:
+        """select 的流式版本, 参数见 stream_scalars_by_orm"""
+        if kwargs.get("mappings", False):
+            orm = select(*table.__table__.columns).where(*conditions)
+        else:
+            orm = select(table).where(*conditions)
+        async for row in self.stream_scalars_by_orm(orm, session, fetch_size, **kwargs):
+            yield row
+
+    @catch
+    async def fetch_rows(
+            self,
+            orm,
+            session: AsyncSession,
+            fmt: str = "tuple",
+            params: dict | None = None,
+            **kwargs) -> List | dict:
+        """
+        绕过 ORM 的快速查询, 在 session 的连接上直接执行 Core 语句, 不创建 ORM 对象, 也不写入 identity map
+        适合只需要把结果返回给前端的列表接口
+        :param orm: select() 语句, select(Model) 返回模型表的所有列; 也可以是原生 SQL 字符串
+        :param fmt:
+            tuple: [(1, "a"), ...]
+            dict: [{"id": 1, "data": "a"}, ...]
+            columns: {"id": [1, ...], "data": ["a", ...]}, 按列存储, 序列化后体积更小
+        :param params: 原生 SQL 的参数
+            kwargs:
+                use_primary: 查询使用主库
+        """
+        if isinstance(orm, str):
+            orm = sqlalchemy.text(orm)
+            # text 语句默认路由到主库, 这里是只读查询
+            if not kwargs.get("use_primary", False):
+                orm = orm.execution_options(use_replica=True)
+        elif kwargs.get("use_primary", False):
+            orm = orm.execution_options(use_primary=True)
+
+        conn = await session.connection(bind_arguments={"clause": orm})
+        result = await conn.execute(orm, params)
+        keys = list(result.keys())
+        rows = result.all()
+        if fmt == "tuple":
+            return [tuple(row) for row in rows]
+        if fmt == "dict":
+            return [dict(zip(keys, row)) for row in rows]
+        if fmt == "columns":
+            values = list(zip(*rows)) if rows else [()] * len(keys)
+            return {key: list(column) for key, column in zip(keys, values)}
+        raise ValueError(f"unsupported fmt {fmt}")
+
+    @catch
+    async def select_rows(
+            self,
+            table,
+            conditions: tuple,
+            session: AsyncSession,
+            fmt: str = "tuple",
+            **kwargs) -> List | dict:
+        """
+        select 的快速版本, 返回值见 fetch_rows
+            kwargs:
+                columns: 只查询部分列, 默认查询模型表的所有列
+                order_by, limit: 见 select
+        """
+        orm = select(*(kwargs.get("columns") or table.__table__.columns)).where(*conditions)
+        if kwargs.get("order_by") is not None:
+            orm = orm.order_by(kwargs["order_by"])
+        if kwargs.get("limit"):
+            orm = orm.limit(kwargs["limit"])
+        return await self.fetch_rows(orm, session, fmt, **kwargs)
+
     @catch
     async def insert(self, table, values: dict, session: AsyncSession):
         stmt = insert(table).values(**values)
@@ -47,11 +187,220 @@ class DatabaseAccessObjects(object):
         stmt = insert(table)
         return await session.execute(stmt, data_list)
 
+    @catch
+    async def bulk_copy(
+            self,
+            table,
+            rows: AsyncIterable | Iterable,
+            session: AsyncSession,
+            columns: List[str] | None = None,
+            chunk_size: int = 10000) -> int:
+        """
+        使用 PostgreSQL COPY 协议批量写入, 比 bulk_insert 的 executemany 快得多
+        通过 session 的底层 asyncpg 连接执行, 和调用方的其他语句在同一个事务中, 需要调用方提交
+        COPY 不会执行模型的 Python 端默认值, 也不能跳过 tuple 中的列:
+            dict 行缺少的列使用 Column(default=...) 填充, 没有默认值的写入 NULL
+            未出现的自增主键和 server_default 列由数据库生成
+        :param table: ORM 模型
+        :param rows: 可迭代对象或异步可迭代对象, 元素为 dict (key 为模型属性名), 或者按 columns 顺序排列的 tuple
+        :param columns: 模型属性名, 默认使用第一个 dict 行的 key 加上有 Python 端默认值的列, tuple 行必须指定
+        :param chunk_size: 每次 COPY 的行数
+        :return: 写入的行数
+        """
+        mapper = sqlalchemy.inspect(table)
+        # 模型属性名 -> 数据库列
+        attr_columns = {attr.key: attr.columns[0] for attr in mapper.column_attrs}
+        # 模型属性名 -> Python 端默认值, ColumnDefault.arg 为可调用对象时接收一个 context 参数
+        defaults = {
+            key: (column.default.arg if column.default.is_callable else lambda _, value=column.default.arg: value)
+            for key, column in attr_columns.items()
+            if column.default is not None and (column.default.is_scalar or column.default.is_callable)
+        }
+
+        def get_value(row: dict, column: str):
+            if column in row:
+                return row[column]
+            return defaults[column](None) if column in defaults else None
+
+        conn = await session.connection()
+        driver_conn = (await conn.get_raw_connection()).driver_connection
+        # asyncpg 适配器在第一次执行语句时才开启事务, 保证 COPY 在事务中执行
+        if not driver_conn.is_in_transaction():
+            await conn.execute(sqlalchemy.text("SELECT 1"))
+
+        total, start_time, db_columns = 0, time.perf_counter(), None
+        async for chunk in self._iter_chunks(rows, chunk_size):
+            if db_columns is None:
+                if isinstance(chunk[0], dict):
+                    columns = list(columns or chunk[0])
+                    columns += [key for key in defaults if key not in columns]
+                elif not columns:
+                    raise ValueError(f"bulk_copy {table.__tablename__}: columns is required for tuple rows")
+                db_columns = [attr_columns[column].name if column in attr_columns else column for column in columns]
+            records = [
+                tuple(get_value(row, column) for column in columns) if isinstance(row, dict) else tuple(row)
+                for row in chunk
+            ]
+            await driver_conn.copy_records_to_table(
+                table.__table__.name,
+                records=records,
+                columns=db_columns,
+                schema_name=table.__table__.schema,
+            )
+            total += len(records)
+        # COPY 不经过 SQLAlchemy, 记录修改的表, 提交后由 orm_listen 失效查询缓存
+        conn.sync_connection.info.setdefault("modified_tables", set()).add(f"table:{table.__table__.name}")
+
+        used_time = time.perf_counter() - start_time
+        dao_log.info(
+            f"bulk_copy {table.__tablename__} {total} rows, used {used_time:.2f}s, "
+            f"{total / used_time if used_time else 0:.0f} rows/s"
+        )
+        return total
+
+    @staticmethod
+    async def _iter_chunks(rows: AsyncIterable | Iterable, chunk_size: int) -> AsyncIterator[List]:
+        chunk = []
+        if hasattr(rows, "__aiter__"):
+            async for row in rows:
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+        else:
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    @catch
+    async def bulk_upsert(
+            self,
+            table,
+            rows: List[dict],
+            conflict_cols: List[str],
+            update_cols: List[str] | None,
+            session: AsyncSession,
+            returning: List | None = None,
+            chunk_size: int | None = None) -> int | List:
+        """
+        INSERT ... ON CONFLICT (conflict_cols) DO UPDATE, 一条语句完成插入或更新, 替代逐行的先查询再更新
+        :param rows: 每行的 key 需要相同
+        :param conflict_cols: 唯一约束或主键的列
+        :param update_cols: 冲突时更新的列, None 表示更新除 conflict_cols 外的所有列, 空列表表示 DO NOTHING
+        :param returning: 需要返回的列, 例如 [Record.id, Record.version]
+        :param chunk_size: 每条语句的行数, 默认按绑定参数上限计算
+        :return: returning 为 None 时返回影响的行数, 否则返回所有返回的行
+        """
+        if not rows:
+            return [] if returning else 0
+
+        # 同一条语句中相同的冲突键只能出现一次, 保留最后一行
+        deduplicated = {tuple(row[col] for col in conflict_cols): row for row in rows}
+        rows = list(deduplicated.values())
+
+        columns = list(rows[0])
+        if update_cols is None:
+            update_cols = [col for col in columns if col not in conflict_cols]
+        chunk_size = min(chunk_size or PG_MAX_PARAMS, PG_MAX_PARAMS // len(columns))
+
+        affected, returned = 0, []
+        for i in range(0, len(rows), chunk_size):
+            stmt = pg_insert(table).values(rows[i: i + chunk_size])
+            if update_cols:
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=conflict_cols,
+                    set_={col: stmt.excluded[col] for col in update_cols},
+                )
+            else:
+                stmt = stmt.on_conflict_do_nothing(index_elements=conflict_cols)
+            if returning:
+                stmt = stmt.returning(*returning)
+
+            result = await session.execute(stmt)
+            if returning:
+                returned.extend(result.all())
+            else:
+                affected += result.rowcount
+        return returned if returning else affected
+
     @catch
     async def update(self, table, conditions: List, values: dict, session: AsyncSession):
         stmt = update(table).where(*conditions).values(**values)
         return await session.execute(stmt)
 
+    # 版本冲突通过 StaleDataError 通知调用方, 不使用 @catch
+    async def update_if_version(
+            self,
+            table,
+            pk: Any,
+            version: int,
+            values: dict,
+            session: AsyncSession,
+            version_col: str = "version") -> int:
+        """
+        乐观锁更新, 不需要 redis 锁
+            UPDATE table SET ..., version = COALESCE(version, 0) + 1 WHERE id = :pk AND version = :version RETURNING version
+        :param pk: 主键的值
+        :param version: 读取数据时的版本, 没有版本 (NULL) 的旧数据传入 None, 更新后版本为 1
+        :return: 更新后的版本
+        :raise StaleDataError: 数据已被其他请求修改或者已删除
+        """
+        pk_column = sqlalchemy.inspect(table).primary_key[0]
+        column = getattr(table, version_col)
+        stmt = (
+            update(table)
+            .where(pk_column == pk, column == version)
+            # version 为 NULL 时 version + 1 仍然是 NULL, 当作 0 处理
+            .values(**values, **{version_col: sqlalchemy.func.coalesce(column, 0) + 1})
+            .returning(column)
+        )
+        new_version = (await session.execute(stmt)).scalar_one_or_none()
+        if new_version is None:
+            raise StaleDataError(f"{table.__tablename__} {pk} version {version} conflict")
+        return new_version
+
+    async def update_with_retry(
+            self,
+            table,
+            pk: Any,
+            func: Callable,
+            session: AsyncSession,
+            retries: int = DAO_CAS_MAX_RETRIES,
+            version_col: str = "version") -> Any:
+        """
+        读取最新数据, 由 func 计算新值, 再通过 update_if_version 写入; 版本冲突时等待后重新读取, 最多重试 retries 次
+            async def handler(session):
+                # 热点行的并发累加, 不需要 AsyncRedisLock
+                await dao.update_with_retry(Record, 1, lambda row: {"data": row.data + "!"}, session)
+        :param func: 参数为当前的 ORM 对象, 返回需要更新的列, 可以是异步函数
+        :return: 更新后的 ORM 对象, 数据不存在时返回 None
+        :raise StaleDataError: 重试次数用完后仍然冲突
+        """
+        pk_column = sqlalchemy.inspect(table).primary_key[0]
+        # 写操作之后的读取使用主库, 并覆盖 identity map 中的旧值
+        orm = select(table).where(pk_column == pk).execution_options(use_primary=True, populate_existing=True)
+        for attempt in range(retries + 1):
+            row = (await session.execute(orm)).scalar_one_or_none()
+            if row is None:
+                return None
+            values = func(row)
+            if inspect.isawaitable(values):
+                values = await values
+            try:
+                await self.update_if_version(table, pk, getattr(row, version_col), values, session, version_col)
+            except StaleDataError:
+                if attempt >= retries:
+                    raise
+                # 指数退避加随机抖动, 避免冲突的请求再次同时重试
+                await asyncio.sleep(DAO_CAS_RETRY_BACKOFF * (2 ** attempt) * (0.5 + random.random()))
+                dao_log.info(f"{table.__tablename__} {pk} version conflict, retry {attempt + 1}")
+                continue
+            return (await session.execute(orm)).scalar_one()
+
     @catch
     async def select(
             self,
@@ -59,9 +408,191 @@ class DatabaseAccessObjects(object):
             conditions: tuple,
             session: AsyncSession,
             **kwargs) -> ScalarResult:
+        """
+            kwargs:
+                order_by: 排序的列
+                limit: 最多返回的行数
+                其他参数见 get_scalars_by_orm
+        """
         orm = select(table).where(*conditions)
+        if kwargs.get("order_by") is not None:
+            orm = orm.order_by(kwargs["order_by"])
+        if kwargs.get("limit"):
+            orm = orm.limit(kwargs["limit"])
         return await self.get_scalars_by_orm(orm, session, **kwargs)
 
+    @catch
+    async def select_by_keys(
+            self,
+            table,
+            column: sqlalchemy.Column,
+            keys: List,
+            session: AsyncSession,
+            chunk_size: int = DAO_ARRAY_CHUNK_SIZE,
+            **kwargs) -> List:
+        """
+        WHERE column = ANY(:keys), key 很多时按 chunk_size 分批查询
+        :return: 所有批次的结果
+        """
+        rows = []
+        for chunk in iter_key_chunks(keys, chunk_size):
+            rows.extend(await self.select(table, (any_condition(column, chunk),), session, **kwargs))
+        return rows
+
+    @catch
+    async def update_by_keys(
+            self,
+            table,
+            column: sqlalchemy.Column,
+            keys: List,
+            values: dict,
+            session: AsyncSession,
+            chunk_size: int = DAO_ARRAY_CHUNK_SIZE) -> int:
+        """
+        UPDATE ... WHERE column = ANY(:keys), 按 chunk_size 分批执行
+        :return: 更新的行数
+        """
+        count = 0
+        for chunk in iter_key_chunks(keys, chunk_size):
+            stmt = update(table).where(any_condition(column, chunk)).values(**values)
+            count += (await session.execute(stmt)).rowcount
+        return count
+
+    @catch
+    async def delete_by_keys(
+            self,
+            table,
+            column: sqlalchemy.Column,
+            keys: List,
+            session: AsyncSession,
+            chunk_size: int = DAO_ARRAY_CHUNK_SIZE) -> int:
+        """
+        DELETE ... WHERE column = ANY(:keys), 按 chunk_size 分批执行
+        :return: 删除的行数
+        """
+        count = 0
+        for chunk in iter_key_chunks(keys, chunk_size):
+            count += (await session.execute(delete(table).where(any_condition(column, chunk)))).rowcount
+        return count
+
+    @catch
+    async def paginate(
+            self,
+            table,
+            order_column: sqlalchemy.Column,
+            session: AsyncSession,
+            conditions: tuple = (),
+            limit: int = 20,
+            cursor: str | None = None,
+            desc: bool = False,
+            total: str | None = None,
+            after: Any = None,
+            **kwargs) -> dict:
+        """
+        keyset 分页, 使用上一页最后一行的排序值作为条件, 代价和页码无关
+        :param order_column: 有序且唯一的列, 通常是主键
+        :param cursor: 上一页返回的 next_cursor, 第一页为 None, 格式错误时会被 catch 吞掉并返回 None
+        :param desc: 是否倒序
+        :param total: None 不统计总数, exact 使用 COUNT(*), estimate 使用 pg_class.reltuples 或 EXPLAIN 的估算行数
+        :param after: 已经用 decode_cursor 解析的 cursor, 接口层应先解析并对格式错误返回 400, 再传入该参数
+        :return: {"items": [...], "next_cursor": str | None, "total": int | None, "total_estimated": bool}
+        """
+        page_conditions = tuple(conditions)
+        if cursor:
+            after = self.decode_cursor(cursor, order_column)
+        if after is not None:
+            page_conditions += (order_column < after if desc else order_column > after,)
+
+        # 多查一行, 判断是否还有下一页
+        items = list(await self.select(
+            table,
+            page_conditions,
+            session,
+            order_by=order_column.desc() if desc else order_column,
+            limit=limit + 1,
+            **kwargs
+        ))
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_cursor = self.encode_cursor(getattr(items[-1], order_column.key))
+
+        page = {"items": items, "next_cursor": next_cursor, "total": None, "total_estimated": False}
+        if total == "exact":
+            page["total"] = await self.count(table, conditions, session)
+        elif total == "estimate":
+            page["total"] = await self.estimate_count(table, conditions, session)
+            page["total_estimated"] = True
+        return page
+
+    @staticmethod
+    def _cursor_default(value: Any) -> str:
+        """json 不支持的排序值转换为字符串, decode_cursor 按列类型转换回来"""
+        if isinstance(value, (datetime.date, datetime.datetime, datetime.time)):
+            return value.isoformat()
+        if isinstance(value, (decimal.Decimal, uuid.UUID)):
+            return str(value)
+        raise TypeError(f"cursor value of type {type(value).__name__} is not JSON serializable")
+
+    @classmethod
+    def encode_cursor(cls, value: Any) -> str:
+        return base64.urlsafe_b64encode(json.dumps({"v": value}, default=cls._cursor_default).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: str, order_column: sqlalchemy.Column) -> Any:
+        """cursor 来自客户端, 格式错误或者和列类型不一致时抛出 ValueError"""
+        try:
+            value = json.loads(base64.urlsafe_b64decode(cursor.encode()))["v"]
+            try:
+                python_type = order_column.type.python_type
+            except NotImplementedError:
+                return value
+            # asyncpg 不会自动转换参数类型, 字符串需要转换回 python 对象
+            if python_type in (datetime.date, datetime.datetime, datetime.time):
+                return python_type.fromisoformat(value)
+            if python_type in (decimal.Decimal, uuid.UUID):
+                return python_type(value)
+            if python_type is float and isinstance(value, int):
+                return float(value)
+            if not isinstance(value, python_type):
+                raise TypeError(f"expected {python_type.__name__}, got {type(value).__name__}")
+            return value
+        except Exception as e:
+            raise ValueError(f"invalid cursor {cursor!r}: {e}") from e
+
+    @catch
+    async def count(self, table, conditions: tuple, session: AsyncSession) -> int:
+        orm = select(sqlalchemy.func.count()).select_from(table).where(*conditions)
+        return (await session.execute(orm)).scalar_one()
+
+    @catch
+    async def estimate_count(self, table, conditions: tuple, session: AsyncSession) -> int:
+        """
+        估算行数, 不扫描表
+            1. 没有条件时使用 pg_class.reltuples, 表从未 ANALYZE 时为 -1, 此时改用 EXPLAIN
+            2. 有条件时使用 EXPLAIN 的估算行数
+        """
+        if not conditions:
+            result = await session.execute(
+                sqlalchemy.text(
+                    "SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:name AS regclass)"
+                ).execution_options(use_replica=True),
+                {"name": table.__table__.fullname},
+            )
+            reltuples = result.scalar_one_or_none()
+            if reltuples is not None and reltuples >= 0:
+                return reltuples
+
+        orm = select(table).where(*conditions)
+        sql = orm.compile(dialect=session.bind.dialect, compile_kwargs={"literal_binds": True})
+        result = await session.execute(
+            sqlalchemy.text(f"EXPLAIN (FORMAT JSON) {sql}").execution_options(use_replica=True)
+        )
+        plan = result.scalar_one()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
     @catch
     async def query_with_options(
             self,
@@ -101,6 +632,11 @@ class DatabaseAccessObjects(object):
     async def get_condition_in(self, column: sqlalchemy.Column, other: List):
         return column.in_(other)
 
+    @catch
+    async def get_condition_any(self, column: sqlalchemy.Column, other: List):
+        """get_condition_in 的数组参数版本, 见 any_condition"""
+        return any_condition(column, other)
+
     # 先将某个对象移除再恢复, 期间自定义操作
 
     @catch
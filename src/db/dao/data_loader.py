@@ -0,0 +1,113 @@
+# -*- encoding: utf-8 -*-
+
+import asyncio
+from typing import Any, Dict, List, Set, Tuple
+
+import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.db.dao.common import dao
+
+
+class DataLoader(object):
+    """
+    按 (模型, 列) 批量加载, 解决循环中逐个 dao.select 的 N+1 查询
+        1. 同一个事件循环 tick 中的 load(key) 合并为一次 WHERE column = ANY(:keys) 查询
+        2. 结果在当前请求 (session) 内缓存, 再次 load 相同的 key 不会查询
+        3. 列不唯一时使用 many=True, 每个 key 返回一个列表
+        4. 同一个 session 的所有 DataLoader 共用 get_session_lock 返回的锁, 查询不会并发执行
+            AsyncSession 不允许并发执行语句, 在 load 等待期间并发使用同一个 session 的其他 dao 调用也需要持有该锁
+
+    async def handler(session):
+        loader = get_loader(session, Record, Record.id)
+        records = await asyncio.gather(*(loader.load(record_id) for record_id in record_ids))
+    """
+
+    def __init__(self, session: AsyncSession, table, column: sqlalchemy.Column, many: bool = False) -> None:
+        self.session = session
+        self.table = table
+        self.column = column
+        self.many = many
+        # key -> 结果, 包括正在查询中的 key
+        self.cache: Dict[Any, asyncio.Future] = {}
+        # 等待查询的 (key, future), 查询结束后只处理这些 future, 不受期间 clear 的影响
+        self.queue: List[Tuple[Any, asyncio.Future]] = []
+        self.tasks: Set[asyncio.Task] = set()
+        # 同一个 session 不能并发执行语句, 和该 session 的其他 DataLoader 共用
+        self.lock = get_session_lock(session)
+
+    def load(self, key: Any) -> asyncio.Future:
+        future = self.cache.get(key)
+        if future is not None:
+            return future
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.cache[key] = future
+        self.queue.append((key, future))
+        # 当前 tick 中第一个 load 负责安排查询, 之后的 load 只需要加入队列
+        if len(self.queue) == 1:
+            loop.call_soon(self._dispatch)
+        return future
+
+    async def load_many(self, keys: List[Any]) -> List[Any]:
+        return list(await asyncio.gather(*(self.load(key) for key in keys)))
+
+    def clear(self, key: Any = None) -> None:
+        """数据被修改后清除缓存, key 为 None 时清除全部"""
+        if key is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(key, None)
+
+    def _dispatch(self) -> None:
+        pending, self.queue = self.queue, []
+        task = asyncio.create_task(self._batch_load(pending))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _batch_load(self, pending: List[Tuple[Any, asyncio.Future]]) -> None:
+        keys = [key for key, _ in pending]
+        try:
+            async with self.lock:
+                rows = await dao.select_by_keys(self.table, self.column, keys, self.session)
+            if rows is None:
+                raise RuntimeError(f"DataLoader load {self.table.__tablename__}.{self.column.key} failed")
+        except Exception as e:
+            for key, future in pending:
+                # 失败的结果不缓存, 但不能删除 clear 之后重新 load 的 future
+                if self.cache.get(key) is future:
+                    del self.cache[key]
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        results: Dict[Any, Any] = {}
+        for row in rows:
+            value = getattr(row, self.column.key)
+            if self.many:
+                results.setdefault(value, []).append(row)
+            else:
+                results[value] = row
+
+        for key, future in pending:
+            if not future.done():
+                future.set_result(results.get(key, [] if self.many else None))
+
+
+def get_session_lock(session: AsyncSession) -> asyncio.Lock:
+    """
+    session 级别的锁, 保存在 session.info 中
+        async with get_session_lock(session):
+            await dao.update(...)
+    """
+    return session.info.setdefault("session_lock", asyncio.Lock())
+
+
+def get_loader(session: AsyncSession, table, column: sqlalchemy.Column, many: bool = False) -> DataLoader:
+    """获取当前请求的 DataLoader, 保存在 session.info 中, 随 session 一起释放"""
+    loaders: Dict[tuple, DataLoader] = session.info.setdefault("data_loaders", {})
+    key = (table, column.key, many)
+    if key not in loaders:
+        loaders[key] = DataLoader(session, table, column, many)
+    return loaders[key]
@@ -0,0 +1,108 @@
+# -*- encoding: utf-8 -*-
+
+import asyncio
+from typing import Dict, List, Set
+
+from sqlalchemy import Row, insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from src.core import dao_log, BATCH_INSERT_MAX_SIZE, BATCH_INSERT_MAX_DELAY
+from src.db.async_pg import pg_async_engine
+
+
+class InsertBatcher(object):
+    """
+    合并并发的单行插入, 减少每行一次的网络往返和 WAL 刷盘
+        1. 同一张表、相同列的插入在 max_delay 秒内, 或者达到 max_size 行时, 合并为一条多行 INSERT
+        2. 使用独立的连接和事务执行, 不在调用方的 session 中, 调用返回时数据已经提交
+        3. 每个调用方得到自己那一行 RETURNING 的结果; 批量插入失败时逐行重试, 每个调用方得到自己的异常
+
+    async def handler():
+        row = await insert_batcher.insert(Record, {"data": "data", "version": 1})
+        print(row.id)
+    """
+
+    def __init__(
+            self,
+            engine: AsyncEngine = None,
+            max_size: int = BATCH_INSERT_MAX_SIZE,
+            max_delay: float = BATCH_INSERT_MAX_DELAY,
+    ):
+        self.engine = engine or pg_async_engine
+        self.max_size = max_size
+        self.max_delay = max_delay
+        # (表, 列, 返回列) -> [(values, future)]
+        self.pending: Dict[tuple, List[tuple[dict, asyncio.Future]]] = {}
+        self.returning: Dict[tuple, List] = {}
+        self.timers: Dict[tuple, asyncio.TimerHandle] = {}
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def insert(self, table, values: dict, returning: List | None = None) -> Row:
+        """
+        :param table: ORM 模型
+        :param values: 一行数据
+        :param returning: 需要返回的列, 默认为主键
+        :return: returning 的列组成的行
+        """
+        returning = returning or list(table.__table__.primary_key.columns)
+        key = (table, tuple(sorted(values)), tuple(column.key for column in returning))
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self.pending.setdefault(key, [])
+        batch.append((values, future))
+        self.returning.setdefault(key, returning)
+
+        if len(batch) >= self.max_size:
+            self._flush(key)
+        elif key not in self.timers:
+            self.timers[key] = loop.call_later(self.max_delay, self._flush, key)
+        return await future
+
+    def _flush(self, key: tuple) -> None:
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.pending.pop(key, [])
+        returning = self.returning.pop(key, None)
+        if not batch:
+            return
+        task = asyncio.create_task(self._execute(key[0], batch, returning))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _execute(self, table, batch: List[tuple[dict, asyncio.Future]], returning: List) -> None:
+        # sort_by_parameter_order 保证返回的行和参数的顺序一致
+        stmt = insert(table).returning(*returning, sort_by_parameter_order=True)
+        try:
+            async with self.engine.begin() as conn:
+                rows = (await conn.execute(stmt, [values for values, _ in batch])).all()
+        except Exception as e:
+            dao_log.warning(f"batch insert {table.__tablename__} {len(batch)} rows error: {e!r}, retry row by row")
+            await self._execute_one_by_one(stmt, batch)
+            return
+
+        for (_, future), row in zip(batch, rows):
+            if not future.done():
+                future.set_result(row)
+
+    async def _execute_one_by_one(self, stmt, batch: List[tuple[dict, asyncio.Future]]) -> None:
+        for values, future in batch:
+            if future.done():
+                continue
+            try:
+                async with self.engine.begin() as conn:
+                    row = (await conn.execute(stmt, [values])).one()
+                future.set_result(row)
+            except Exception as e:
+                future.set_exception(e)
+
+    async def close(self) -> None:
+        """立即写入所有等待中的数据, 在 lifespan 退出时调用"""
+        for key in list(self.pending):
+            self._flush(key)
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+insert_batcher = InsertBatcher()
@@ -4,7 +4,6 @@
 from sqlalchemy import create_engine, Column, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import StaleDataError
 
 Base = declarative_base()
 
@@ -12,4 +11,9 @@ class Record(Base):
     __tablename__ = 'record'
     id = Column(Integer, primary_key=True)
     data = Column(String)
-    version = Column(Integer)
\ No newline at end of file
+    # 已有数据需要先补齐版本: UPDATE record SET version = 1 WHERE version IS NULL, 再加上 NOT NULL 约束
+    version = Column(Integer, nullable=False, default=1)
+
+    # 乐观锁, ORM flush 时 UPDATE ... WHERE id = ? AND version = ? 并自动加 1, 版本不一致时抛出 StaleDataError
+    # INSERT 时 ORM 自动把版本设置为 1
+    __mapper_args__ = {"version_id_col": version}
@@ -8,9 +8,17 @@ from fastapi import FastAPI
 from fastapi.middleware.gzip import GZipMiddleware
 from starlette.middleware.cors import CORSMiddleware
 
-from src.core import f_log, TITLE, ALLOWED_HOSTS
-from src.utils import use_static_swagger
-from src.aop import ErrorLoggingMiddleware
+from src.core import f_log, TITLE, ALLOWED_HOSTS, CACHE_L2_ENABLED, REDIS_CLIENT_CACHE_ENABLED
+from src.utils import use_static_swagger, client_cache
+from src.db import warmup_pg_pool
+from src.db.dao import insert_batcher
+from src.aop import (
+    ErrorLoggingMiddleware,
+    ServerTimingMiddleware,
+    start_cache_invalidation_listener,
+    run_cache_warmup,
+    cache,
+)
 from src.api import router
 
 @asynccontextmanager
@@ -20,8 +28,21 @@ async def lifespan(app: FastAPI):
     f_log.info(colored_art)
     print(colored_art)
 
+    if CACHE_L2_ENABLED:
+        await start_cache_invalidation_listener()
+
+    if REDIS_CLIENT_CACHE_ENABLED:
+        await client_cache.start()
+
+    await warmup_pg_pool()
+
+    loaded, used_time = await run_cache_warmup()
+    f_log.info(f"Cache warmup loaded {loaded} entries, used {used_time:.2f}s, cache size {len(cache)}")
+
     yield
 
+    await insert_batcher.close()
+    await client_cache.stop()
     f_log.info("Service shutdown...")
 
 
@@ -42,6 +63,7 @@ app.add_middleware(
 )
 app.add_middleware(GZipMiddleware, minimum_size=1000)
 app.add_middleware(ErrorLoggingMiddleware)
+app.add_middleware(ServerTimingMiddleware)
 app.include_router(router, prefix="")
 
 
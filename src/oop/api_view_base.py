@@ -1,16 +1,84 @@
 # -*- coding: utf-8 -*-
 
+import io
+import csv
+import json
+import hashlib
 import inspect
 import functools
-from typing import List
+import contextlib
+from typing import Any, AsyncIterable, AsyncIterator, Dict, List
 
-from fastapi import APIRouter
+import sqlalchemy
+from fastapi import APIRouter, HTTPException, Response, params
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
 
+from src.core import current_request
 from src.schema import StdRes
+from src.db.dao import dao
+from src.aop.cache_decorate import cache, register_warmup
+
+
+def compute_etag(body: bytes) -> str:
+    # gzip 等编码会改变响应内容, 所以使用弱校验的 ETag
+    return 'W/"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # 弱比较, 忽略 W/ 前缀
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in tags
+
+
+def row_to_dict(row: Any) -> dict:
+    """ORM 对象、RowMapping、pydantic 模型转换为 dict"""
+    if isinstance(row, dict):
+        return row
+    if isinstance(row, BaseModel):
+        return row.model_dump()
+    if isinstance(row, sqlalchemy.RowMapping):
+        return dict(row)
+    return {attr.key: getattr(row, attr.key) for attr in sqlalchemy.inspect(row).mapper.column_attrs}
+
+
+async def iter_ndjson(rows: AsyncIterable) -> AsyncIterator[str]:
+    async for row in rows:
+        yield json.dumps(jsonable_encoder(row_to_dict(row)), ensure_ascii=False) + "\n"
+
+
+async def iter_csv(rows: AsyncIterable) -> AsyncIterator[str]:
+    buffer = io.StringIO()
+    writer = None
+    async for row in rows:
+        row = jsonable_encoder(row_to_dict(row))
+        if writer is None:
+            # 使用第一行的 key 作为表头
+            writer = csv.DictWriter(buffer, fieldnames=list(row))
+            writer.writeheader()
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
 
 
 class BaseApiView(object):
 
+    # keyset 分页, 子类声明 page_model 和 page_column 后, 可以在视图函数中调用 self.get_page
+    page_model = None
+    # 有序且唯一的列名, 通常是主键
+    page_column: str = "id"
+    page_size: int = 20
+    page_max_size: int = 100
+    page_desc: bool = False
+    # None 不统计总数, exact 精确统计, estimate 估算
+    page_total: str | None = None
+
     def __init__(self, **kwargs):
         self.method_keys = [
             "post",
@@ -26,6 +94,132 @@ class BaseApiView(object):
         self._summary = kwargs.get("summary") or "Api Summary"
         self._tags = kwargs.get("tags") or []
         self.method_decorator: dict = kwargs.get("method_decorator", {})
+        # 条件请求, True 表示只对 get 生效, 也可以指定方法列表, 例如 ["get", "head"]
+        etag = kwargs.get("etag", False)
+        self.etag_methods: List[str] = (["get"] if etag is True else list(etag or []))
+        # 缓存预热, 方法名 -> 热点请求参数列表, 例如 {"get": [{"request_body": {"box_id": 1}}]}
+        # 需要搭配 get_cache_decorator 使用, 启动时会用这些参数调用一次视图函数
+        self.warmup: Dict[str, List[dict]] = kwargs.get("warmup", {})
+
+    async def warmup_call(self, method: str, kwargs: dict) -> Any:
+        """
+        使用预热参数调用视图函数, 请求体参数会转换为对应的 pydantic 模型, 保证和真实请求的缓存 key 一致
+        未提供的 Depends 参数会直接调用其依赖函数, 只支持没有子依赖的依赖函数, 例如 async_session
+        """
+        func = getattr(self, method)
+        kwargs = dict(kwargs)
+        async with contextlib.AsyncExitStack() as stack:
+            for name, param in inspect.signature(func).parameters.items():
+                annotation = param.annotation
+                if name in kwargs:
+                    if (
+                            inspect.isclass(annotation)
+                            and issubclass(annotation, BaseModel)
+                            and isinstance(kwargs[name], dict)
+                    ):
+                        kwargs[name] = annotation.model_validate(kwargs[name])
+                elif isinstance(param.default, params.Depends):
+                    kwargs[name] = await self.resolve_dependency(param.default.dependency, stack)
+            return await self.func_decorator(func)(**kwargs)
+
+    @staticmethod
+    async def resolve_dependency(dependency, stack: contextlib.AsyncExitStack) -> Any:
+        if inspect.isasyncgenfunction(dependency):
+            return await stack.enter_async_context(contextlib.asynccontextmanager(dependency)())
+        if inspect.isgeneratorfunction(dependency):
+            return stack.enter_context(contextlib.contextmanager(dependency)())
+        if inspect.iscoroutinefunction(dependency):
+            return await dependency()
+        return dependency()
+
+    def etag_response(self, func, result: Any, kwargs: dict) -> Any:
+        """
+        为响应计算 ETag, 请求头 If-None-Match 匹配时返回 304, 不再序列化和压缩响应体
+        结果来自 get_cache_decorator 的缓存时, ETag 会保存在缓存条目中, 之后的请求不需要再计算
+        """
+        if isinstance(result, Response):
+            return result
+
+        request = current_request.get()
+        if_none_match = request.headers.get("if-none-match") if request is not None else None
+        cache_key = cache.get_key(kwargs.get("request_body"), func, self.__class__.__name__)
+
+        etag = cache.get_etag(cache_key, result)
+        if etag is not None and etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
+        response = JSONResponse(content=jsonable_encoder(result))
+        if etag is None:
+            etag = compute_etag(response.body)
+            cache.set_etag(cache_key, result, etag)
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
+        response.headers["ETag"] = etag
+        return response
+
+    async def get_page(
+            self,
+            session,
+            cursor: str | None = None,
+            size: int | None = None,
+            conditions: tuple = (),
+    ) -> StdRes:
+        """
+        根据类属性声明的分页配置返回一页数据, 例如:
+            class RecordView(BaseApiView):
+                page_model = Record
+                page_total = "estimate"
+
+                async def get(self, cursor: str = None, size: int = 20, session=Depends(async_session)):
+                    return await self.get_page(session, cursor, size)
+        """
+        if self.page_model is None:
+            raise ValueError(f"{self.__class__.__name__}.page_model is not set")
+        size = min(size or self.page_size, self.page_max_size)
+        order_column = getattr(self.page_model, self.page_column)
+        # 在 dao.paginate 的 catch 之外解析 cursor, 客户端传入错误的 cursor 返回 400 而不是 500
+        try:
+            after = dao.decode_cursor(cursor, order_column) if cursor else None
+        except ValueError:
+            raise HTTPException(status_code=400, detail="invalid cursor")
+        page = await dao.paginate(
+            self.page_model,
+            order_column,
+            session,
+            conditions=conditions,
+            limit=size,
+            desc=self.page_desc,
+            total=self.page_total,
+            after=after,
+        )
+        page["items"] = [row_to_dict(item) for item in page["items"]]
+        return StdRes(data=page)
+
+    @staticmethod
+    def stream_response(rows: AsyncIterable, fmt: str = "ndjson", filename: str | None = None) -> StreamingResponse:
+        """
+        将异步迭代器逐行输出为 NDJSON 或 CSV, 内存占用和行数无关, 通常搭配 dao.stream_select 使用
+        注意: Depends 提供的 session 在开始发送响应前就会关闭, rows 需要在生成器内部自己创建 session, 例如:
+            async def rows():
+                async with pg_sessionmaker() as session:
+                    async for record in dao.stream_select(Record, (), session):
+                        yield record
+
+            return self.stream_response(rows(), fmt="csv", filename="record.csv")
+        :param rows: 元素为 ORM 对象、RowMapping、dict 或 pydantic 模型
+        :param fmt: ndjson 或 csv
+        :param filename: 设置后作为附件下载
+        """
+        if fmt == "ndjson":
+            content, media_type = iter_ndjson(rows), "application/x-ndjson"
+        elif fmt == "csv":
+            content, media_type = iter_csv(rows), "text/csv"
+        else:
+            raise ValueError(f"fmt must be ndjson or csv, got {fmt}")
+
+        headers = {"Content-Disposition": f'attachment; filename="{filename}"'} if filename else None
+        return StreamingResponse(content, media_type=media_type, headers=headers)
 
     def func_decorator(self, func):
 
@@ -44,9 +238,14 @@ class BaseApiView(object):
             return await decorated_function(self.__class__.__name__, *args, **kwargs)
 
 
+        use_etag = func.__name__ in self.etag_methods
+
         @functools.wraps(func)
         async def wrap(*args, **kwargs):
-            return await dispatch(*args, **kwargs)
+            result = await dispatch(*args, **kwargs)
+            if use_etag:
+                return self.etag_response(func, result, kwargs)
+            return result
 
         def dispatch_sync(*args, **kwargs):
             # 列表装饰器, 按照索引顺序执行
@@ -64,7 +263,10 @@ class BaseApiView(object):
 
         @functools.wraps(func)
         async def wrap_sync(*args, **kwargs):
-            return dispatch_sync(*args, **kwargs)
+            result = dispatch_sync(*args, **kwargs)
+            if use_etag:
+                return self.etag_response(func, result, kwargs)
+            return result
 
         is_async = inspect.iscoroutinefunction(func)
         return wrap if is_async else wrap_sync
@@ -84,6 +286,11 @@ class BaseApiView(object):
                     tags=self.tags,
                     **kwargs,
                 )
+                for warmup_kwargs in self.warmup.get(method, []):
+                    register_warmup(
+                        f"{self.__class__.__name__}.{method}",
+                        functools.partial(self.warmup_call, method, warmup_kwargs),
+                    )
 
     @property
     def tags(self) -> List:
@@ -4,8 +4,10 @@ import time
 import traceback
 from asyncio import Queue
 
+from redis import exceptions as redis_exceptions
+
 from src.core import broad_log, BROADCASTER_TYPE
-from src.db import redis_db
+from src.db import redis_db, redis_read_router
 
 
 class BroadCaster(object):
@@ -44,14 +46,20 @@ class BroadCasterRedis(BroadCaster):
 
     async def __pub_event(self):
         while True:
-            mess = await self.queue_send.get()
+            # 取出队列中已有的所有消息, 通过一个 pipeline 发送
+            messages = [await self.queue_send.get()]
+            while not self.queue_send.empty() and len(messages) < 100:
+                messages.append(self.queue_send.get_nowait())
             try:
-                broad_log.info(f"Publish message, {mess}, {self.queue_send.qsize()}")
+                broad_log.info(f"Publish message, {messages}, {self.queue_send.qsize()}")
                 t1 = time.time()
-                await self.redis.xadd(self.topic, {"data": json.dumps(mess)}, maxlen=1000)
-                t2 = time.time()
-                if t2 - t1 > 800:
-                    broad_log.warning(f"Save redis xadd function used time is, {t2 - t1} ms")
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for mess in messages:
+                        pipe.xadd(self.topic, {"data": json.dumps(mess)}, maxlen=1000)
+                    await pipe.execute()
+                used_time = (time.time() - t1) * 1000
+                if used_time > 800:
+                    broad_log.warning(f"Save redis xadd function used time is, {used_time} ms")
             except Exception as ex:
                 broad_log.error(f"publish error: {traceback.format_exc()}")
 
@@ -61,14 +69,19 @@ class BroadCasterRedis(BroadCaster):
         """
         last_id = "$"
         while True:
+            # 阻塞读取使用从库, 出错后暂时改用主库
+            client = redis_read_router.get_client(self.redis)
             try:
-                result = await self.redis.xread(streams={self.topic: last_id}, block=200)
+                result = await client.xread(streams={self.topic: last_id}, block=200)
                 if result:
                     last_id = result[0][1][-1][0]
                     for _id, value in result[0][1]:
                         value = json.loads(value[b"data"])
                         broad_log.info(f"Receive message, {value}")
                         await self.queue_recv.put(value)
+            except (redis_exceptions.ConnectionError, redis_exceptions.TimeoutError):
+                redis_read_router.mark_failed(client)
+                broad_log.error(f"receive error: {traceback.format_exc()}")
             except Exception as ex:
                 broad_log.error(f"receive error: {traceback.format_exc()}")
 
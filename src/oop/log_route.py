@@ -6,7 +6,7 @@ from typing import Callable
 from fastapi import APIRouter, Request, Response
 from fastapi.routing import APIRoute
 
-from src.core import request_get_log, request_post_log
+from src.core import request_get_log, request_post_log, current_request
 
 def try_format(body):
     try:
@@ -34,6 +34,7 @@ class LogReqContextRoute(APIRoute):
                 logger_req = request_get_log
             else:
                 logger_req = request_post_log
+            token = current_request.set(request)
             try:
                 response = await original_route_handler(request)
             except Exception as exc:
@@ -42,9 +43,12 @@ class LogReqContextRoute(APIRoute):
                 req_body = try_format(body)
                 logger_req.error(f"detail [{req_id}]\n<<<<<<<<<<<< \n{req_body}\n============")
                 raise exc
+            finally:
+                current_request.reset(token)
             body = await request.body()
             req_body = try_format(body)
-            res_body = try_format(response.body)
+            # StreamingResponse 没有 body 属性, 内容边发送边生成, 不记录响应体
+            res_body = try_format(getattr(response, "body", b"<streaming>"))
             logger_req.info(f"new request \"{request.url.path}\": {req_info}")
             logger_req.info(f"detail [{req_id}]\n<<<<<<<<<<<< \n{req_body}\n>>>>>>>>>>>>\n{res_body}\n============")
             return response
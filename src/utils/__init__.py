@@ -1,4 +1,7 @@
 from .swagger_monkey import *
 from .tools import *
 from .redis_lock import * 
-from .redis_pubsub import *
\ No newline at end of file
+from .redis_pubsub import *
+from .redis_single_flight import *
+from .redis_idempotency import *
+from .redis_client_cache import *
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+import uuid
+import asyncio
+import traceback
+import collections
+from typing import Any, Dict, Iterable
+
+from redis import asyncio as aioredis
+
+from src.core import (
+    f_log,
+    REDIS_CLIENT_CACHE_PREFIXES,
+    REDIS_CLIENT_CACHE_MAX_ENTRIES,
+    REDIS_HEALTH_CHECK_INTERVAL,
+)
+from src.db import redis_db
+
+
+class RedisClientCache(object):
+    """
+    基于 CLIENT TRACKING 的客户端缓存, 用于几乎每个请求都会读取、很少修改的 key, 如配置开关
+        1. 使用一个独立连接开启 BCAST 模式的 tracking, 并把失效通知重定向到它自己订阅的 __redis__:invalidate 频道
+            任何连接修改了匹配前缀的 key, 服务端都会发送失效通知, 不需要在连接池的每个连接上开启 tracking
+        2. 匹配前缀的 key 第一次读取后保存在本地 LRU 中, 之后的读取不访问 redis, 收到失效通知时立即删除
+        3. 失效通知的连接断开时清空本地缓存, 重新连接前所有读取直接访问 redis
+
+    redis-py 5.0 的 asyncio 客户端不支持 RESP3 的 push 消息, 这里使用 RESP2 的 REDIRECT + 订阅频道方式接收失效通知
+
+    async def run():
+        await client_cache.start()
+        # 第一次访问 redis, 之后在本地命中, 直到 key 被修改
+        value = await client_cache.get("config:feature_flag")
+    """
+
+    channel = "__redis__:invalidate"
+
+    def __init__(
+            self,
+            client: aioredis.Redis = None,
+            prefixes: Iterable[str] = REDIS_CLIENT_CACHE_PREFIXES,
+            max_entries: int = REDIS_CLIENT_CACHE_MAX_ENTRIES,
+            ping_interval: float = REDIS_HEALTH_CHECK_INTERVAL or 30,
+            retry_interval: float = 1,
+    ):
+        """
+
+        :param client: asyncio redis client, 需要连接主库
+        :param prefixes: 只缓存以这些前缀开头的 key
+        :param max_entries: 本地最多缓存的 key 数量
+        :param ping_interval: 没有失效通知时, 每隔多少秒发送 PING 检查连接
+        :param retry_interval: 连接断开后重连的间隔, 单位秒
+        """
+        self.client = client or redis_db
+        self.prefixes = tuple(prefixes)
+        self.max_entries = max_entries
+        self.ping_interval = ping_interval
+        self.retry_interval = retry_interval
+        self.cache_map: collections.OrderedDict[str, Any] = collections.OrderedDict()
+        # key -> 正在从 redis 读取的 token, 读取期间收到失效通知时删除, 读取结果不再写入本地缓存
+        self.pending: Dict[str, str] = {}
+        self.connected = False
+        self.hits = 0
+        self.misses = 0
+        self._task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self.cache_map)
+
+    def cacheable(self, key: str) -> bool:
+        return self.connected and key.startswith(self.prefixes)
+
+    async def get(self, key: str) -> bytes | None:
+        if not self.cacheable(key):
+            return await self.client.get(key)
+
+        if key in self.cache_map:
+            self.hits += 1
+            self.cache_map.move_to_end(key)
+            return self.cache_map[key]
+
+        self.misses += 1
+        token = uuid.uuid4().hex
+        self.pending[key] = token
+        try:
+            value = await self.client.get(key)
+        finally:
+            valid = self.pending.get(key) == token
+            if valid:
+                del self.pending[key]
+        # 读取期间没有收到失效通知, 并且连接没有断开, 才写入本地缓存
+        if valid and self.connected:
+            self.cache_map[key] = value
+            self.cache_map.move_to_end(key)
+            while len(self.cache_map) > self.max_entries:
+                self.cache_map.popitem(last=False)
+        return value
+
+    def invalidate(self, keys: Iterable[bytes | str] | None) -> None:
+        """keys 为 None 表示 FLUSHDB / FLUSHALL, 清空所有本地缓存"""
+        if keys is None:
+            self.clear()
+            return
+        for key in keys:
+            key = key.decode() if isinstance(key, bytes) else key
+            self.cache_map.pop(key, None)
+            self.pending.pop(key, None)
+
+    def clear(self) -> None:
+        self.cache_map.clear()
+        self.pending.clear()
+
+    def get_status(self) -> dict:
+        return {"connected": self.connected, "size": len(self.cache_map), "hits": self.hits, "misses": self.misses}
+
+    async def start(self) -> None:
+        """启动失效通知的监听, 重复调用只会启动一次"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._listen_forever())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.connected = False
+        self.clear()
+
+    async def _listen_forever(self) -> None:
+        while True:
+            try:
+                await self._listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                f_log.error(f"redis client cache listener error: {traceback.format_exc()}")
+            finally:
+                # 断开期间可能错过失效通知, 本地缓存不再可信
+                self.connected = False
+                self.clear()
+            await asyncio.sleep(self.retry_interval)
+
+    async def _listen(self) -> None:
+        pool = self.client.connection_pool
+        # 独立于连接池的连接; 订阅状态下 PING 的返回值不是 PONG, 关闭连接自带的健康检查, 由下面的循环发送 PING
+        conn = pool.connection_class(**{**pool.connection_kwargs, "health_check_interval": 0})
+        try:
+            await conn.connect()
+            await conn.send_command("CLIENT", "ID")
+            client_id = await conn.read_response()
+
+            args = ["CLIENT", "TRACKING", "on", "REDIRECT", client_id, "BCAST"]
+            for prefix in self.prefixes:
+                args.extend(["PREFIX", prefix])
+            await conn.send_command(*args)
+            await conn.read_response()
+
+            await conn.send_command("SUBSCRIBE", self.channel)
+            await conn.read_response()
+            self.connected = True
+            f_log.info(f"redis client cache tracking prefixes {self.prefixes}, client id {client_id}")
+
+            while True:
+                # 指定 timeout 时超时返回 None, 不会断开连接
+                message = await conn.read_response(timeout=self.ping_interval)
+                if message is None:
+                    await conn.send_command("PING")
+                    continue
+                # [b"message", b"__redis__:invalidate", [b"key", ...] 或 None]
+                if isinstance(message, list) and message[0] == b"message":
+                    self.invalidate(message[2])
+        finally:
+            await conn.disconnect()
+
+
+client_cache = RedisClientCache()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import uuid
+import pickle
+import asyncio
+import traceback
+from typing import Any, Awaitable, Callable
+
+from redis import asyncio as aioredis
+
+from src.core import (
+    f_log,
+    IDEMPOTENCY_PREFIX,
+    IDEMPOTENCY_TTL,
+    IDEMPOTENCY_LOCK_TIMEOUT,
+)
+from src.db import redis_db
+
+
+class RedisIdempotencyStore(object):
+    """
+    基于 redis 的幂等键存储, 用于至少一次投递的回调接口
+        1. 第一次请求通过 SET NX 写入执行中状态, 执行完成后写入完成状态和结果, 保留 ttl 秒
+        2. 重复请求如果已经完成, 直接返回保存的结果; 仍在执行中, 则等待执行结果
+        3. 执行出错时删除幂等键, 允许发送方重试; 执行者异常退出时, 执行中状态在 lock_timeout 后过期
+
+    async def run():
+        async def callback():
+            return "result"
+
+        # 相同的幂等键只会执行一次 callback, 不论请求落在哪个 worker
+        result = await idempotency_store.run("event:id", callback)
+    """
+
+    in_progress = b"in_progress"
+
+    # 只有执行中状态的持有者才可以删除, 避免删除其他请求写入的状态
+    release_script = """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("del", KEYS[1])
+    else
+        return 0
+    end
+    """
+
+    def __init__(
+            self,
+            client: aioredis.client.Redis = None,
+            prefix: str = IDEMPOTENCY_PREFIX,
+            ttl: int = IDEMPOTENCY_TTL,  # s
+            lock_timeout: int = IDEMPOTENCY_LOCK_TIMEOUT,  # ms
+            poll_interval: float = 0.2,
+    ):
+        """
+
+        :param client: asyncio redis client
+        :param prefix: redis key 的前缀
+        :param ttl: 完成状态和结果的保留时间
+        :param lock_timeout: 执行中状态的过期时间
+        :param poll_interval: 重复请求等待执行结果时的轮询间隔, 单位秒
+        """
+        self.client = client or redis_db
+        self.prefix = prefix
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}:{key}"
+
+    async def run(self, key: str, func: Callable[[], Awaitable], ttl: int | None = None) -> Any:
+        """
+        :param key: 幂等键
+        :param func: 无参数的异步函数
+        :param ttl: 覆盖默认的结果保留时间
+        :return: func 的结果, 或者之前相同幂等键保存的结果
+        """
+        redis_key = self._key(key)
+        # 执行中状态带上 token, 区分不同的执行者
+        token = self.in_progress + b":" + uuid.uuid4().hex.encode()
+        while True:
+            try:
+                if await self.client.set(redis_key, token, nx=True, px=self.lock_timeout):
+                    break
+                raw = await self.client.get(redis_key)
+            except Exception:
+                # redis 不可用时降级为直接执行
+                f_log.error(f"idempotency store {key} error: {traceback.format_exc()}")
+                return await func()
+
+            if raw is not None and not raw.startswith(self.in_progress):
+                f_log.info(f"idempotency key {key} already done, return the stored result")
+                return pickle.loads(raw)
+            # 仍在执行中, 或者状态刚被删除, 等待后重试
+            await asyncio.sleep(self.poll_interval)
+
+        try:
+            result = await func()
+        except Exception:
+            await self._release(redis_key, token)
+            raise
+
+        try:
+            await self.client.set(redis_key, pickle.dumps(result), ex=ttl or self.ttl)
+        except Exception:
+            f_log.error(f"idempotency store save {key} error: {traceback.format_exc()}")
+        return result
+
+    async def _release(self, redis_key: str, token: bytes) -> None:
+        try:
+            await self.client.eval(self.release_script, 1, redis_key, token)
+        except Exception:
+            f_log.error(f"idempotency store release {redis_key} error: {traceback.format_exc()}")
+
+
+idempotency_store = RedisIdempotencyStore()
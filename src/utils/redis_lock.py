@@ -6,7 +6,7 @@ from http import client
 
 from redis import asyncio as aioredis
 
-from src.db import redis_db
+from src.db import redis_db, get_auto_pipeline
 
 
 class AsyncRedisLock:
@@ -49,11 +49,21 @@ class AsyncRedisLock:
     async def _acquire(self):
         """尝试获取锁"""
         while True:
-            if await self.redis_client.set(self.key, self.token, nx=True, px=self.lock_timeout):
+            if await self.try_acquire():
                 return True
             # 等待一段时间后重试
             await asyncio.sleep(self.retry_interval)
 
+    async def try_acquire(self) -> bool:
+        """只尝试一次, 不等待"""
+        # 通过自动 pipeline 发送, 大量并发加锁时合并为少量往返
+        pipe = get_auto_pipeline(self.redis_client)
+        return bool(await pipe.set(self.key, self.token, nx=True, px=self.lock_timeout))
+
+    async def locked(self) -> bool:
+        """锁是否被持有, 持有者异常退出时锁会在 lock_timeout 后过期"""
+        return bool(await get_auto_pipeline(self.redis_client).exists(self.key))
+
     async def _release(self):
         """释放锁"""
         # 使用Lua脚本确保操作的原子性
@@ -64,7 +74,7 @@ class AsyncRedisLock:
             return 0
         end
         """
-        return await self.redis_client.eval(script, 1, self.key, self.token)
+        return await get_auto_pipeline(self.redis_client).eval(script, 1, self.key, self.token)
 
     async def __aenter__(self):
         await self._acquire()
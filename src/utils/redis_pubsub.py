@@ -7,8 +7,9 @@ import traceback
 from typing import Callable, Any
 
 from redis import asyncio as aioredis, ResponseError
+from redis import exceptions as redis_exceptions
 
-from src.db import redis_db
+from src.db import redis_db, get_auto_pipeline, redis_read_router
 
 class EventHandle(object):
     def __init__(self, client = None):
@@ -24,6 +25,9 @@ class EventHandle(object):
         :param kwargs:
         :return:  b'1716345367494-1'
         """
+        # 只使用 maxlen 参数时通过自动 pipeline 发送, 同一时刻的多条消息合并为一次往返
+        if set(kwargs) <= {"maxlen", "approximate"}:
+            return await get_auto_pipeline(self.client).xadd(topic, {"data": json.dumps(value)}, **kwargs)
         return await self.client.xadd(topic, {"data": json.dumps(value)}, **kwargs)
 
 
@@ -71,12 +75,17 @@ class RedisPubSubHandle(EventHandle):
         :return:
         """
         while True:
+            # 阻塞读取使用从库, 出错后暂时改用主库, 消息 id 在主从之间一致, 可以继续读取
+            client = redis_read_router.get_client(self.client)
             try:
-                result = await self.client.xread(streams={topic: last_id}, block=block, **kwargs)
+                result = await client.xread(streams={topic: last_id}, block=block, **kwargs)
                 if result:
                     last_id = result[0][1][-1][0]
                     for _id, value in result[0][1]:
                         await callback(json.loads(value[b"data"]))
+            except (redis_exceptions.ConnectionError, redis_exceptions.TimeoutError):
+                redis_read_router.mark_failed(client)
+                traceback.print_exc()
             except Exception as e:
                 traceback.print_exc()
 
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+import json
+import pickle
+import asyncio
+import traceback
+from typing import Any, Awaitable, Callable, Dict, List
+
+from redis import asyncio as aioredis
+
+from src.core import (
+    f_log,
+    SINGLE_FLIGHT_PREFIX,
+    SINGLE_FLIGHT_LOCK_TIMEOUT,
+    SINGLE_FLIGHT_RESULT_TTL,
+)
+from src.db import redis_db
+from src.utils.redis_lock import AsyncRedisLock
+from src.utils.redis_pubsub import RedisPubSubHandle
+
+
+class RedisSingleFlight(object):
+    """
+    跨 worker 的 single-flight
+        1. 通过 AsyncRedisLock 选出 leader, leader 执行函数后把结果写入 redis, 再通过 redis streams 通知其他 worker
+        2. follower 不执行函数, 收到通知后读取 leader 的结果
+            结果以 leader 锁的 token 区分, follower 只接受当前这一轮 leader 的结果, 不会读到上一轮残留的旧结果
+        3. leader 执行出错, 或者异常退出导致锁过期, follower 在本地执行函数
+
+    async def run():
+        async def query():
+            await asyncio.sleep(1)
+            return "result"
+
+        # 多个 worker 同时调用, 只有一个 worker 会执行 query
+        result = await single_flight.do("query:key", query)
+    """
+
+    def __init__(
+            self,
+            client: aioredis.client.Redis = None,
+            prefix: str = SINGLE_FLIGHT_PREFIX,
+            lock_timeout: int = SINGLE_FLIGHT_LOCK_TIMEOUT,  # ms
+            result_ttl: int = SINGLE_FLIGHT_RESULT_TTL,  # ms
+            poll_interval: float = 0.5,
+    ):
+        """
+
+        :param client: asyncio redis client
+        :param prefix: redis key 的前缀
+        :param lock_timeout: leader 锁的过期时间
+        :param result_ttl: leader 结果在 redis 中保留的时间
+        :param poll_interval: follower 检查 leader 是否存活的间隔, 单位秒
+        """
+        self.client = client or redis_db
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self.topic = f"{prefix}:done"
+        self.pubsub = RedisPubSubHandle(self.client)
+        # (key, leader token) -> 当前 worker 中等待该 leader 结果的 follower
+        self.waiters: Dict[tuple[str, str], List[asyncio.Future]] = {}
+        self._listener_started = False
+
+    def _lock_key(self, key: str) -> str:
+        return f"{self.prefix}:lock:{key}"
+
+    def _result_key(self, key: str, token: str) -> str:
+        return f"{self.prefix}:result:{key}:{token}"
+
+    async def do(self, key: str, func: Callable[[], Awaitable]) -> Any:
+        """
+        :param key: 相同 key 的调用只执行一次
+        :param func: 无参数的异步函数
+        :return: func 的结果
+        """
+        lock = AsyncRedisLock(self.client, key=self._lock_key(key), lock_timeout=self.lock_timeout)
+        try:
+            await self._start_listener()
+            is_leader = await lock.try_acquire()
+            leader_token = None if is_leader else await self.client.get(lock.key)
+        except Exception:
+            # redis 不可用时降级为本地执行
+            f_log.error(f"single flight acquire {key} error: {traceback.format_exc()}")
+            return await func()
+
+        if is_leader:
+            return await self._lead(key, func, lock)
+        if leader_token is None:
+            # leader 在两次命令之间刚好释放了锁, 它的结果可能早于本次调用, 在本地执行
+            return await func()
+        return await self._follow(key, func, leader_token.decode())
+
+    async def _lead(self, key: str, func: Callable[[], Awaitable], lock: AsyncRedisLock) -> Any:
+        try:
+            result = await func()
+        except Exception:
+            # 通知 follower 在本地执行
+            await self._notify(key, ok=False, lock=lock)
+            raise
+
+        await self._notify(key, ok=True, lock=lock, result=result)
+        return result
+
+    async def _notify(self, key: str, ok: bool, lock: AsyncRedisLock, result: Any = None) -> None:
+        try:
+            # 结果和通知在同一个 pipeline 中按顺序发送, 只需要一次往返
+            async with self.client.pipeline(transaction=False) as pipe:
+                if ok:
+                    pipe.set(self._result_key(key, lock.token), pickle.dumps(result), px=self.result_ttl)
+                pipe.xadd(
+                    self.topic,
+                    {"data": json.dumps({"key": key, "token": lock.token, "ok": ok})},
+                    maxlen=1000,
+                )
+                await pipe.execute()
+        except Exception:
+            f_log.error(f"single flight notify {key} error: {traceback.format_exc()}")
+        finally:
+            # 先写结果再释放锁, follower 发现锁不存在且没有结果时, 说明 leader 失败了
+            try:
+                await lock._release()
+            except Exception:
+                f_log.error(f"single flight release {key} error: {traceback.format_exc()}")
+
+    async def _follow(self, key: str, func: Callable[[], Awaitable], token: str) -> Any:
+        """:param token: 当前 leader 锁的 token, 只接受该 leader 的结果"""
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault((key, token), []).append(fut)
+        try:
+            while True:
+                try:
+                    ok = await asyncio.wait_for(asyncio.shield(fut), self.poll_interval)
+                except asyncio.TimeoutError:
+                    ok = None
+                if ok is False:
+                    break
+
+                found, result = await self._get_result(key, token)
+                if found:
+                    return result
+                # 没有收到通知, 并且同一个 leader 还持有锁, 继续等待
+                if ok is None and await self.client.get(self._lock_key(key)) == token.encode():
+                    continue
+                break
+        except Exception:
+            f_log.error(f"single flight wait {key} error: {traceback.format_exc()}")
+        finally:
+            waiters = self.waiters.get((key, token), [])
+            if fut in waiters:
+                waiters.remove(fut)
+            if not waiters:
+                self.waiters.pop((key, token), None)
+
+        f_log.warning(f"single flight leader of {key} failed, execute locally")
+        return await func()
+
+    async def _get_result(self, key: str, token: str) -> tuple[bool, Any]:
+        raw = await self.client.get(self._result_key(key, token))
+        if raw is None:
+            return False, None
+        return True, pickle.loads(raw)
+
+    async def _on_done(self, message: dict) -> None:
+        for fut in self.waiters.get((message.get("key"), message.get("token")), []):
+            if not fut.done():
+                fut.set_result(message.get("ok"))
+
+    async def _start_listener(self) -> None:
+        if self._listener_started:
+            return
+        self._listener_started = True
+        await self.pubsub.subscribe(self._on_done, self.topic)
+
+
+single_flight = RedisSingleFlight()